@@ -3,53 +3,335 @@
 # 2.plot spectrogram
 # 3.compute fingerprints (2 versions)
 # 4.match two fingerprints
+# 5.compute peak-pair hashes (ver.3) and vote on time offsets
+# 6.stream spectrogram and fingerprints of long recordings, from
+#   memory-mapped samples or from samples arriving block by block
+#   (Rolling, Hashes)
 
 import numpy as np
+import functools
 import logging
+from scipy import ndimage
 from scipy import signal
 from scipy.io import wavfile
 from scipy.spatial import distance
-import matplotlib
-import matplotlib.pyplot as plt
+import metrics
 
 
 log = logging.getLogger(__name__)
 
-
-def spectrogram(pathfile):
+# analysis settings of each fingerprint table
+# + fingerprint: ver.1 & ver.2, stored side by side for each window
+# + hash: ver.3
+# rate: samples per second to resample to (None keeps the original)
+# window, hop: spectrogram windows (seconds)
+# bands: band layout of ver.2, see band_edges()
+SETTINGS = {
+    "fingerprint": {"rate": 8000, "window": 1.0, "hop": 0.5, "bands": "octave"},
+    "hash": {"rate": 8000, "window": 0.2, "hop": 0.1},
+}
+# settings of databases built before they were recorded
+LEGACY_SETTINGS = {
+    "fingerprint": {"rate": None, "window": 10, "hop": 1},
+    "hash": {"rate": None, "window": 10, "hop": 1},
+}
+# windows per block when streaming a long recording
+BLOCK = 16
+# votes ahead of the runner-up to stop comparing a snippet, see align()
+LEAD = 10
+# songs aligned with a snippet after the pre-filter, see candidates()
+CANDIDATES = 20
+
+
+def spectrogram(pathfile, settings=None):
     """read a wav file and return its spectrogram"""
     if not pathfile.endswith(".wav"):
         log.error("audio file must be in wav format")
     else:
         framerate, series = wavfile.read(pathfile)
         log.info("wav file processed")
+
+        return spectrogram_series(framerate, series, settings)
+
+
+def spectrogram_series(framerate, series, settings=None):
+    """return the spectrogram of samples already in memory
+
+    Params
+    + framerate (int) - samples per second
+    + series (array) - samples, shape (n,) or (n, channels)
+    + settings (dict) - rate, window and hop, default SETTINGS["fingerprint"]
+
+    Return
+    + rate (int) - samples per second after resampling
+    + f, t, spect - see scipy.signal.spectrogram
+    """
+    settings = settings or SETTINGS["fingerprint"]
+    rate = settings["rate"] or framerate
+    series = resample(series, framerate, rate)
+    f, t, spect = stft(series, rate, settings)
+
+    return rate, f, t, spect
+
+
+@metrics.timed("analyze.resample")
+def resample(series, framerate, rate, first=0, last=None):
+    """convert to one channel and resample to rate
+
+    only samples first to last (excluded) of the result are computed,
+    from the matching input samples plus a margin for the filter, so
+    slices of a long recording agree with resampling it all at once
+
+    Params
+    + series (array) - samples, shape (n,) or (n, channels)
+    + framerate (int) - samples per second of series
+    + rate (int) - samples per second of the result
+    """
+    g = np.gcd(int(rate), int(framerate))
+    up, down = int(rate) // g, int(framerate) // g
+    if last is None:
+        last = -(-len(series) * up // down)
+    # input slice, aligned on multiples of down
+    margin = (10 * max(up, down) // up // down + 2) * down
+    a = max(first // up * down - margin, 0)
+    b = min(-(-last * down // up) + margin, len(series))
+    chunk = np.asarray(series[a:b])
+    if chunk.ndim > 1:
         # series[:,0] -> left channel
         # series[:,1] -> right channel
         # take mean to get one-channel series
-        series = np.mean(series, axis=1)
-        log.info("series converted to one-channel")
+        chunk = np.mean(chunk, axis=1)
+    if up != down:
+        chunk = signal.resample_poly(chunk, up, down)
+    a = a * up // down
+
+    return chunk[first - a:last - a]
+
+
+@metrics.timed("analyze.spectrogram")
+def stft(series, rate, settings):
+    """spectrogram of one-channel samples, with hamming windows"""
+    nperseg = int(round(settings["window"] * rate))
+    hop = int(round(settings["hop"] * rate))
+    f, t, spect = signal.spectrogram(
+        series,
+        fs=rate,
+        nperseg=nperseg,
+        noverlap=nperseg - hop,
+        window="hamming"
+    )
+    metrics.count("windows", spect.shape[1])
+    log.info("spectrogram computed: %s windows", spect.shape[1])
+
+    return f, t, spect
+
+
+def read(pathfile):
+    """memory-map a wav file, samples are read from disk when used"""
+    framerate, series = wavfile.read(pathfile, mmap=True)
+    log.info("wav file mapped")
+
+    return framerate, series
+
+
+def stream_spectrogram(framerate, series, settings=None, block=BLOCK):
+    """compute the spectrogram of a long recording block by block
+
+    same windows as spectrogram_series(), but only `block` windows
+    (and their samples) are in memory at once
+
+    Yield
+    + (f, t, spect) - spectrogram of each block of windows
+    """
+    settings = settings or SETTINGS["fingerprint"]
+    rate = settings["rate"] or framerate
+    nperseg = int(round(settings["window"] * rate))
+    hop = int(round(settings["hop"] * rate))
+    n = -(-len(series) * rate // framerate)
+    n_windows = max(1, (n - nperseg) // hop + 1)
+
+    for start in range(0, n_windows, block):
+        stop = min(start + block, n_windows)
+        chunk = resample(series, framerate, rate, start*hop, (stop-1)*hop + nperseg)
+        f, t, spect = stft(chunk, rate, settings)
+        yield f, t + start*hop/rate, spect
+
+
+def stream_fingerprints(framerate, series, settings=None, block=BLOCK):
+    """compute fingerprints (ver.1 & 2) of a long recording block by block
+
+    Yield
+    + (t, fingerprints1, fingerprints2) of each block
+    """
+    settings = settings or SETTINGS["fingerprint"]
+    rate = settings["rate"] or framerate
+    for f, t, spect in stream_spectrogram(framerate, series, settings, block):
+        bands = settings.get("bands", "octave")
+        yield t, fingerprint(f, spect), fingerprint2(f, spect, rate, bands)
+
 
-        f, t, spect = signal.spectrogram(
-            series,
-            fs=framerate,
-            nperseg=10*framerate,
-            noverlap=(10-1)*framerate,
-            window="hamming"
-        )
-        log.info("spectrogram computed")
+def stream_hashes(framerate, series, settings=None, block=BLOCK, fan_out=15, max_dt=5):
+    """compute fingerprints (ver.3) of a long recording block by block,
+    see Hashes
+
+    Yield
+    + (hashes, anchors) of each block, anchors are window indexes
+      from the beginning of the recording
+    """
+    settings = settings or SETTINGS["hash"]
+    hashes = Hashes(fan_out, max_dt)
+    for _, _, spect in stream_spectrogram(framerate, series, settings, block):
+        yield hashes.add(spect)
+    last = hashes.finish()
+    if last is not None:
+        yield last
 
-        return framerate, f, t, spect
 
+class Hashes:
+    """fingerprints (ver.3) of a spectrogram arriving block by block
+
+    a hash needs one window before its anchor and max_dt+1 windows
+    after it, so the last windows of each block are kept until the
+    next one. anchors are window indexes from the first block
+    """
 
-def plot_spectrogram(f, t, spect):
-    """plot a spectrogram"""
+    def __init__(self, fan_out=15, max_dt=5):
+        self.fan_out = fan_out
+        self.max_dt = max_dt
+        self.context = None
+        # window index of context[:, 0]
+        self.offset = 0
+        # first window with no hash computed yet
+        self.done = 0
+
+    def add(self, spect):
+        """(hashes, anchors) of the anchors with all their targets so far"""
+        context = spect if self.context is None else np.hstack([self.context, spect])
+        # anchors with all their targets in context
+        stop = self.offset + context.shape[1] - (self.max_dt + 1)
+        hashes, anchors = fingerprint3(
+            context, self.fan_out, self.max_dt, self.done - self.offset, stop - self.offset)
+        anchors = anchors + self.offset
+        self.done = max(self.done, stop)
+        # keep the window before the next anchor and everything after
+        keep = max(self.done - 1 - self.offset, 0)
+        self.context = context[:, keep:]
+        self.offset += keep
+
+        return hashes, anchors
+
+    def finish(self):
+        """(hashes, anchors) of the anchors at the very end of the
+        recording, None if there are none left"""
+        if self.context is None or self.done >= self.offset + self.context.shape[1]:
+            return None
+        hashes, anchors = fingerprint3(self.context, self.fan_out, self.max_dt, self.done - self.offset)
+        self.done = self.offset + self.context.shape[1]
+
+        return hashes, anchors + self.offset
+
+
+class Rolling:
+    """spectrogram of samples arriving block by block (a stream, a pipe)
+
+    windows are numbered from the beginning of the stream, and only
+    computed once all their samples (and a margin for the resampling
+    filter) have arrived, so they are the same as for a whole file.
+    spect keeps the windows of the last seconds (see listen.py), the
+    samples no longer needed are dropped
+    """
+
+    def __init__(self, framerate, settings, seconds=0):
+        self.framerate = framerate
+        self.settings = settings
+        self.rate = settings["rate"] or framerate
+        self.nperseg = int(round(settings["window"] * self.rate))
+        self.hop = int(round(settings["hop"] * self.rate))
+        self.seconds = seconds
+        # samples not needed anymore are dropped a second at a time,
+        # keeping the buffer aligned with the resampling
+        self.samples = None
+        self.origin = 0
+        # windows computed so far, and the first one kept
+        self.done = 0
+        self.first = 0
+        self.f = None
+        self.t = np.zeros(0)
+        self.spect = None
+
+    def add(self, samples):
+        """add new samples, shape (n, channels) or (n,)
+
+        Return
+        + (f, t, spect) - the windows completed by these samples,
+          None if there are none
+        """
+        self.samples = samples if self.samples is None else np.concatenate([self.samples, samples])
+        return self.update()
+
+    def finish(self):
+        """the last windows, once the stream has ended: no more samples
+        for the resampling filter, see add()"""
+        if self.samples is None:
+            return None
+        return self.update(last=True)
+
+    def update(self, last=False):
+        """compute the windows of the samples received so far"""
+        received = (self.origin + len(self.samples)) * self.rate // self.framerate
+        # margin for the resampling filter
+        available = received - self.rate // 10 if self.rate != self.framerate and not last else received
+        ready = max((available - self.nperseg) // self.hop + 1, 0)
+        new = None
+        if ready > self.done:
+            start = self.origin * self.rate // self.framerate
+            chunk = resample(self.samples, self.framerate, self.rate,
+                             self.done*self.hop - start, (ready-1)*self.hop + self.nperseg - start)
+            f, t, spect = stft(chunk, self.rate, self.settings)
+            new = f, t + self.done*self.hop/self.rate, spect
+            self.f = f
+            self.t = np.concatenate([self.t, new[1]])
+            self.spect = spect if self.spect is None else np.hstack([self.spect, spect])
+            self.done = ready
+        self.trim()
+
+        return new
+
+    def trim(self):
+        """forget windows and samples older than the buffer"""
+        old = max(len(self.t) - int(self.seconds * self.rate) // self.hop, 0)
+        if old:
+            self.t = self.t[old:]
+            self.spect = self.spect[:, old:]
+            self.first += old
+        # samples of the next window, a second earlier for the filter
+        needed = self.done * self.hop * self.framerate // self.rate - self.framerate
+        drop = max(needed - self.origin, 0) // self.framerate * self.framerate
+        if drop:
+            self.samples = self.samples[drop:]
+            self.origin += drop
+
+    def heard(self):
+        """seconds of audio received"""
+        return (self.origin + (0 if self.samples is None else len(self.samples))) / self.framerate
+
+
+def plot_spectrogram(f, t, spect, outfile=None):
+    """plot a spectrogram, or save the plot to outfile (like "plot.png")"""
+    # matplotlib is slow to import, and only needed here
+    import matplotlib
+    import matplotlib.pyplot as plt
     # normalize the scale, make it easier to see the trends
     plt.pcolormesh(t, f, spect, norm=matplotlib.colors.Normalize(0,1))
     plt.ylabel('Frequency [Hz]')
     plt.xlabel('Time [sec]')
-    plt.show()
+    if outfile is None:
+        plt.show()
+    else:
+        plt.savefig(outfile)
 
 
+@metrics.timed("analyze.fingerprint")
 def fingerprint(f, spect):
     """compute fingerprint (ver.1) from spectrogram
 
@@ -57,54 +339,79 @@ def fingerprint(f, spect):
     find a list of (positive) frequencies f (scaled to [0, 1])
     at which the local periodogram has a peak
     """
-    max_f = max(f)
+    max_f = np.max(f)
     peaks = np.argmax(spect, axis=0)
     fingerprints = f[peaks] / max_f
 
-    log.info("fingerprint (ver.1) computed")
+    log.info("fingerprint (ver.1) computed: %s windows", len(fingerprints))
 
     return np.array(fingerprints)
 
 
-def fingerprint2(f, spect, framerate):
+@metrics.timed("analyze.fingerprint2")
+def fingerprint2(f, spect, framerate, layout="octave"):
     """compute fingerprint (ver.2) from spectrogram
 
     Option 5 in the instruction:
     find the maximum power per octave in local periodograms
+
+    in each band, same as fingerprint() on the slice of the band:
+    the frequency of the peak scaled by the top frequency of the band.
+    see band_edges() for the available layouts
+    """
+    edges = band_edges(len(f), float(f[1] - f[0]), framerate, layout)
+    if np.any(np.diff(edges) <= 0):
+        raise ValueError("a band has no frequency, use longer windows")
+
+    # peak of each band in all windows at once, on views of spect
+    peaks = np.empty((len(edges) - 1, spect.shape[1]), dtype=int)
+    for k, (start, end) in enumerate(zip(edges[:-1], edges[1:])):
+        peaks[k] = start + np.argmax(spect[start:end], axis=0)
+    # transpose to get fingerprint for each window
+    fingerprints = (f[peaks] / f[edges[1:] - 1][:, None]).T
+
+    log.info("fingerprint (ver.2) computed: %s windows", len(fingerprints))
+
+    return fingerprints
+
+
+@functools.lru_cache(maxsize=32)
+def band_edges(n_f, df, framerate, layout="octave"):
+    """index of the first frequency of each band, and end of the last
+
+    Params
+    + n_f (int), df (float) - number and spacing of frequencies
+    + layout (str) - bands between min_f and framerate/4:
+      + octave: 8 octaves
+      + third: 24 third-octaves
+      + mel: 8 bands of equal width on the mel scale
     """
     # m = number of octaves
     # must have m>5 to cover middleC
     # larger m -> better precision
     m = 8
     min_f = int((2**-(m+1))*(framerate/2))
-    fingerprints = []
-
-    log.info("start to iterate through the spectrogram")
-
-    # iterate through all octaves
-    for k in range(m):
-        start = min_f*(2**k)*10
-        end = min_f*(2**(k+1))*10
-        # take subset of spectrogram, slice each octave
-        sub_f = f[start:end]
-        sub_spect = spect[start:end]
-        # compute fingerprint of each subset
-        sub_fingerprint = fingerprint(sub_f, sub_spect)
-        fingerprints.append(sub_fingerprint)
-    # transpose to get fingerprint for each window
-    fingerprints = np.array(fingerprints).T
-
-    log.info("fingerprint (ver.2) computed")
+    if layout == "octave":
+        hz = min_f * 2.0**np.arange(m+1)
+    elif layout == "third":
+        hz = min_f * 2.0**(np.arange(3*m+1) / 3)
+    elif layout == "mel":
+        mel = np.linspace(2595*np.log10(1 + min_f/700),
+                          2595*np.log10(1 + min_f*2**m/700), m+1)
+        hz = 700 * (10**(mel/2595) - 1)
+    else:
+        raise ValueError("expected octave, third or mel band layout")
+    f = np.arange(n_f) * df
 
-    return fingerprints
+    return np.searchsorted(f, hz)
 
 
 def match(f1, f2):
     """compare two fingerprints (ver.1) and see if they match
 
     Params
-    + f1 (num) - fingerprint stored in database, duration=10s
-    + f2 (num) - fingerprint of a snippet, duration>=10s
+    + f1 (num) - fingerprint stored in database, one window
+    + f2 (num) - fingerprint of a snippet, one window
 
     Return
     + boolean, True if match, False otherwise
@@ -128,8 +435,8 @@ def match2(f1, f2):
     """compare two fingerprints (ver.2) and see if they match
 
     Params
-    + f1 (array) - fingerprint stored in database, duration=10s
-    + f2 (array) - fingerprint of a snippet, duration>=10s
+    + f1 (array) - fingerprint stored in database, one window
+    + f2 (array) - fingerprint of a snippet, one window
 
     Return
     + boolean, True if match, False otherwise
@@ -137,11 +444,244 @@ def match2(f1, f2):
     tolerance = 0.1
 
     if len(f1) == len(f2):
-        pairs = zip(f1, f2)
-        dists = [distance.euclidean(x, y) for x, y in pairs]
-        if all([(d < tolerance) for d in dists]):
+        # euclidean distance of each pair of elements
+        dists = np.abs(np.subtract(f1, f2, dtype=float))
+        if np.all(dists < tolerance):
             return True
         return False
 
     else:
         log.error("expected equal fingerprint lengths")
+
+
+def match2_all_pairs(records, f_snippet):
+    """compare many fingerprints (ver.2) at once, see match2()
+
+    match2() takes the euclidean distance of each pair of elements,
+    that is their absolute difference, and requires all of them under
+    the tolerance: a chebyshev distance under the tolerance
+
+    Return
+    + array, boolean (n, m) matrix, True where record i matches window j
+    """
+    tolerance = 0.1
+    records = np.asarray(records, dtype=float).reshape(-1, np.shape(f_snippet)[1])
+    dists = distance.cdist(records, f_snippet, "chebyshev")
+
+    return dists < tolerance
+
+
+def peaks(spect, size=(21, 3), per_frame=5):
+    """find the constellation map of a spectrogram
+
+    a peak is a local maximum of the spectrogram in a neighbourhood
+    of size (frequency bins, windows). keep the strongest peaks of
+    each window only, to get a sparse and noise robust map
+
+    Return
+    + (array, array) - window index and frequency index of each peak,
+      ordered by window
+    """
+    local = (ndimage.maximum_filter(spect, size=size) == spect) & (spect > 0)
+    power = np.where(local, spect, 0)
+    # candidate rows of the strongest peaks in each window
+    k = min(per_frame, power.shape[0])
+    rows = np.argpartition(-power, k-1, axis=0)[:k]
+    cols = np.broadcast_to(np.arange(power.shape[1]), rows.shape)
+    keep = power[rows, cols] > 0
+    t_idx, f_idx = cols[keep], rows[keep]
+    order = np.lexsort((f_idx, t_idx))
+
+    return t_idx[order], f_idx[order]
+
+
+@metrics.timed("analyze.fingerprint3")
+def fingerprint3(spect, fan_out=15, max_dt=5, start=0, stop=None):
+    """compute fingerprint (ver.3) from spectrogram
+
+    pair each peak of the constellation map (anchor) with the peaks
+    that follow it within max_dt windows, and hash every pair as
+    (f1, f2, dt) packed in a 64-bit integer:
+    + bits 32-51: frequency index of the anchor
+    + bits 12-31: frequency index of the target
+    + bits 0-11: windows between anchor and target
+
+    only anchors in windows start to stop (excluded) are kept, the
+    other windows are context, see stream_fingerprints()
+
+    Return
+    + (array, array) - hashes and window index of their anchors
+    """
+    t_idx, f_idx = peaks(spect)
+    stop = spect.shape[1] if stop is None else stop
+    hashes = []
+    anchors = []
+    for k in range(1, fan_out+1):
+        dt = t_idx[k:] - t_idx[:-k]
+        valid = (dt >= 1) & (dt <= max_dt)
+        valid &= (t_idx[:-k] >= start) & (t_idx[:-k] < stop)
+        f1 = f_idx[:-k][valid].astype(np.int64)
+        f2 = f_idx[k:][valid].astype(np.int64)
+        hashes.append((f1 << 32) | (f2 << 12) | dt[valid])
+        anchors.append(t_idx[:-k][valid])
+    hashes = np.concatenate(hashes).astype(np.int64)
+    anchors = np.concatenate(anchors).astype(np.int64)
+
+    metrics.count("hashes", len(hashes))
+    log.info("fingerprint (ver.3) computed: %s hashes", len(hashes))
+
+    return hashes, anchors
+
+
+@metrics.timed("analyze.vote")
+def vote(hashes, anchors, records):
+    """score songs by voting on time offsets of matching hashes
+
+    a hash of the snippet found in a song votes for the offset
+    (anchor in song - anchor in snippet). the true song gets many
+    votes for the same offset, random matches spread out
+
+    Params
+    + hashes (array) - hashes (ver.3) of a snippet
+    + anchors (array) - anchor windows of the snippet hashes
+    + records (array) - rows of (song_id, hash, anchor) from database
+
+    Return
+    + (array, array, array) - song_ids, their scores (largest number
+      of votes for a single offset) and the offsets with most votes
+    """
+    records = np.asarray(records, dtype=np.int64).reshape(-1, 3)
+    order = np.argsort(hashes, kind="stable")
+    s_hashes, s_anchors = hashes[order], anchors[order]
+    # every snippet occurrence of each hash found in database
+    lo = np.searchsorted(s_hashes, records[:, 1], side="left")
+    hi = np.searchsorted(s_hashes, records[:, 1], side="right")
+    counts = hi - lo
+    rows = np.repeat(np.arange(len(records)), counts)
+    starts = np.repeat(lo - (np.cumsum(counts) - counts), counts)
+    idx = np.arange(counts.sum()) + starts
+    song_ids = records[rows, 0]
+    offsets = records[rows, 2] - s_anchors[idx]
+
+    return best_offsets(song_ids, offsets)
+
+
+def best_offsets(song_ids, offsets):
+    """histogram of votes for (song_id, offset) pairs
+
+    Return
+    + (array, array, array) - song_ids, their scores (largest number
+      of votes for a single offset) and the offsets with most votes
+    """
+    if len(song_ids) == 0:
+        empty = np.array([], dtype=np.int64)
+        return empty, empty, empty
+    pairs, votes = np.unique(
+        np.stack([song_ids, offsets], axis=1), axis=0, return_counts=True)
+    # keep the best offset of each song
+    order = np.lexsort((-votes, pairs[:, 0]))
+    pairs, votes = pairs[order], votes[order]
+    first = np.r_[True, pairs[1:, 0] != pairs[:-1, 0]]
+
+    return pairs[first, 0], votes[first], pairs[first, 1]
+
+
+def match_pairs(records, f_snippet, search=None):
+    """all matching (stored window, snippet window) pairs, see align()
+
+    Return
+    + (array, array) - rows of records and windows of the snippet
+    """
+    f_snippet = np.asarray(f_snippet)
+    if records.ndim == 2 and search is not None:
+        rows, cols = search(f_snippet)
+        # same as match2() on each candidate pair
+        tolerance = 0.1
+        dists = np.abs(records[rows].astype(float) - f_snippet[cols])
+        keep = np.all(dists < tolerance, axis=1)
+        return rows[keep], cols[keep]
+    if records.ndim == 2:
+        return np.nonzero(match2_all_pairs(records, f_snippet))
+    # in float64, match() tolerance underflows in float32
+    return np.nonzero(match(records[:, None], f_snippet[None, :].astype(float)))
+
+
+@metrics.timed("analyze.candidates")
+def candidates(song_ids, f_snippet, records, limit, sample=16, search=None):
+    """pre-filter the songs worth aligning with a snippet
+
+    count the matches of a few snippet windows, spread over the
+    snippet, with every stored window regardless of time offset
+
+    Return
+    + array - song_ids of at most limit songs with most matches
+    """
+    windows = np.unique(np.linspace(0, len(f_snippet)-1, min(sample, len(f_snippet))).astype(int))
+    rows, _ = match_pairs(records, np.asarray(f_snippet)[windows], search)
+    songs, counts = np.unique(song_ids[rows], return_counts=True)
+
+    return songs[np.argsort(-counts, kind="stable")[:limit]]
+
+
+@metrics.timed("analyze.align")
+def align(records, song_ids, centers, f_snippet, t_snippet, hop, step=8, lead=LEAD, search=None):
+    """score songs by voting on time offsets of matching windows
+
+    vote() for fingerprints ver.1 and ver.2: each window of the snippet
+    matching a stored window (see match(), match2()) votes for the
+    offset (center in song - center in snippet), in windows of hop
+    seconds. the snippet is compared step windows at a time, and the
+    comparison stops once the best song leads the runner-up by lead
+    votes, or by more than the windows left (it cannot be overtaken)
+
+    Params
+    + records (array) - n fingerprints stored in database, one per row
+    + song_ids, centers (array) - song_id and center of each row
+    + f_snippet, t_snippet (array) - fingerprints and centers of the
+      m windows of the snippet
+    + search (function) - candidate (rows, windows) pairs of some
+      snippet windows, like index.query(), checked with match2().
+      None compares every row (ver.1 always does)
+
+    Return
+    + (array, array, array) - as vote(), offsets in seconds
+    + int - number of snippet windows compared
+    """
+    records = np.asarray(records)
+    n_windows = len(f_snippet)
+    pairs_ids = []
+    pairs_offsets = []
+    result = best_offsets([], [])
+    compared = 0
+    for start in range(0, n_windows, step):
+        chunk = np.asarray(f_snippet[start:start+step])
+        rows, cols = match_pairs(records, chunk, search)
+        pairs_ids.append(song_ids[rows])
+        pairs_offsets.append(np.round((centers[rows] - t_snippet[start+cols]) / hop).astype(np.int64))
+        compared = start + len(chunk)
+        result = best_offsets(np.concatenate(pairs_ids), np.concatenate(pairs_offsets))
+        scores = np.sort(result[1])[::-1]
+        margin = scores[0] - (scores[1] if len(scores) > 1 else 0) if len(scores) else 0
+        if compared < n_windows and margin >= min(lead, n_windows - compared + 1):
+            log.info("clear match after %s of %s windows", compared, n_windows)
+            break
+    song_ids, scores, offsets = result
+    metrics.count("windows_compared", compared)
+
+    return (song_ids, scores, offsets * hop), compared
+
+
+def confidence(scores, n):
+    """confidence of the best match, from 0 to 1
+
+    the share of the n snippet windows (or hashes) voting for the best
+    song at its offset, beyond those voting for the runner-up: about
+    1 for a clean snippet of a song in database, about 0 when no song
+    stands out (random matches spread over songs and offsets)
+    """
+    if len(scores) == 0 or n == 0:
+        return 0.0
+    scores = np.sort(scores)[::-1]
+    runner_up = scores[1] if len(scores) > 1 else 0
+
+    return float(np.clip((scores[0] - runner_up) / n, 0, 1))
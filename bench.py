@@ -0,0 +1,200 @@
+# RUN THIS PROGRAM TO:
+# measure the performance of ingest and identification
+#
+# python bench.py --songs 100 --seconds 60 --output bench.json
+
+# HOW IT WORKS
+# + a synthetic catalog: each song is a melody of random tones
+#   (a few at a time, changing every half second) plus noise,
+#   no music files and no network needed
+# + snippets are cut from random songs at random offsets, with
+#   some noise added, and identified with each fingerprint type
+# + every stage is timed per item (song, snippet): spectrogram,
+#   fingerprints, database writes, catalog loading, identify
+# + the results (throughput, latency percentiles, peak memory,
+#   accuracy) are written to a json file, to compare runs
+
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import numpy as np
+from scipy.io import wavfile
+import analyze as a
+import catalog
+import database as d
+import fun as f
+import index
+import metrics
+
+
+class Stage:
+    """ timings of one stage, one per item """
+
+    def __init__(self, name, memory=False):
+        self.name = name
+        self.memory = memory
+        self.seconds = []
+        self.audio = 0.0
+        self.peak = 0
+
+    def time(self, function, *args, audio=0.0):
+        """ call function(*args) and record its duration """
+        if self.memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        result = function(*args)
+        self.seconds.append(time.perf_counter() - start)
+        self.audio += audio
+        if self.memory:
+            self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        return result
+
+    def report(self):
+        seconds = np.array(self.seconds)
+        total = float(seconds.sum())
+        report = {
+            "count": len(seconds),
+            "total": total,
+            "mean": float(seconds.mean()),
+            "p50": float(np.percentile(seconds, 50)),
+            "p90": float(np.percentile(seconds, 90)),
+            "p99": float(np.percentile(seconds, 99)),
+            "max": float(seconds.max()),
+            "per_second": len(seconds) / total if total else None,
+        }
+        if self.audio:
+            # seconds of audio processed per second
+            report["audio_per_second"] = self.audio / total if total else None
+        if self.memory:
+            report["peak_bytes"] = self.peak
+        return report
+
+
+def song(rng, seconds, framerate, tones=3, note=0.5):
+    """ a synthetic song: random tones changing every note seconds """
+    n = int(seconds * framerate)
+    per_note = int(note * framerate)
+    t = np.arange(per_note) / framerate
+    notes = []
+    for _ in range(-(-n // per_note)):
+        freqs = rng.uniform(100, framerate / 2.5, size=tones)
+        notes.append(np.sin(2 * np.pi * freqs[:, None] * t).sum(axis=0))
+    series = np.concatenate(notes)[:n] + rng.normal(scale=0.3, size=n)
+
+    return (series / np.abs(series).max() * 20000).astype(np.int16)
+
+
+def run(songs=20, seconds=30, snippets=20, snippet_seconds=5, framerate=8000,
+        noise=0.05, types=(1, 2, 3), seed=0, memory=False, directory=None):
+    """ run the benchmark, see module description
+
+    Return
+    + dict - parameters, environment, stages and accuracy
+    """
+    rng = np.random.default_rng(seed)
+    directory = directory or tempfile.mkdtemp(prefix="freezam_bench_")
+    conn = d.connect("sqlite", os.path.join(directory, "bench.db"))
+    d.create_table(conn)
+    d.add_settings(a.SETTINGS, conn)
+    settings = a.SETTINGS
+    catalog.invalidate()
+    index.invalidate()
+    metrics.reset()
+    stages = {name: Stage(name, memory) for name in [
+        "spectrogram", "fingerprint", "fingerprint2", "fingerprint3",
+        "compute_fingerprints", "db_write", "catalog_load", "index_build"]
+        + ["identify%s" % type for type in types]}
+
+    # ingest
+    library = []
+    for i in range(songs):
+        series = song(rng, seconds, framerate)
+        library.append(series)
+        rate, freqs, _, spect = stages["spectrogram"].time(
+            a.spectrogram_series, framerate, series, settings["fingerprint"], audio=seconds)
+        stages["fingerprint"].time(a.fingerprint, freqs, spect, audio=seconds)
+        stages["fingerprint2"].time(a.fingerprint2, freqs, spect, rate, audio=seconds)
+        _, _, _, spect = a.spectrogram_series(framerate, series, settings["hash"])
+        stages["fingerprint3"].time(a.fingerprint3, spect, audio=seconds)
+        fingerprints = stages["compute_fingerprints"].time(
+            f.compute_fingerprints, framerate, series, settings, audio=seconds)
+        title = "Song%s" % i
+        stages["db_write"].time(write, conn, title, fingerprints, audio=seconds)
+    for version in (1, 2):
+        stages["catalog_load"].time(catalog.load, conn, version)
+    stages["index_build"].time(index.build, conn)
+
+    # identify
+    correct = {type: 0 for type in types}
+    for i in range(snippets):
+        k = int(rng.integers(songs))
+        start = int(rng.integers(0, (seconds - snippet_seconds) * framerate))
+        clip = library[k][start:start + snippet_seconds * framerate].astype(float)
+        clip += rng.normal(scale=noise * np.abs(clip).max(), size=len(clip))
+        pathfile = os.path.join(directory, "snippet%s.wav" % i)
+        wavfile.write(pathfile, framerate, clip.astype(np.int16))
+        for type in types:
+            matches, _ = stages["identify%s" % type].time(
+                f.identify, conn, pathfile, type, audio=snippet_seconds)
+            correct[type] += bool(matches) and matches[0]["title"] == "Song%s" % k
+    conn.close()
+
+    return {
+        "params": {"songs": songs, "seconds": seconds, "snippets": snippets,
+                   "snippet_seconds": snippet_seconds, "framerate": framerate,
+                   "noise": noise, "types": list(types), "seed": seed},
+        "environment": {"python": platform.python_version(), "numpy": np.__version__,
+                        "platform": platform.platform(), "cpus": os.cpu_count()},
+        "stages": {name: stage.report() for name, stage in stages.items() if stage.seconds},
+        "accuracy": {"identify%s" % type: correct[type] / snippets if snippets else None
+                     for type in types},
+        "peak_rss_bytes": metrics.peak_memory(),
+        # timers and counters of each function, see metrics.py
+        "metrics": metrics.snapshot(),
+    }
+
+
+def write(conn, title, fingerprints):
+    """ record a synthetic song and its fingerprints """
+    d.add_song((title, None, None), conn)
+    d.add_fingerprints([(title + ".wav",) + tuple(fingerprints)], conn)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Freezam: benchmark ingest and identification')
+    parser.add_argument('--songs', type=int, default=20, help='songs in the synthetic catalog')
+    parser.add_argument('--seconds', type=int, default=30, help='length of each song')
+    parser.add_argument('--snippets', type=int, default=20, help='snippets to identify')
+    parser.add_argument('--snippet-seconds', type=int, default=5, help='length of each snippet')
+    parser.add_argument('--framerate', type=int, default=8000, help='samples per second of the songs')
+    parser.add_argument('--noise', type=float, default=0.05, help='noise added to snippets')
+    parser.add_argument('--types', type=str, default='1,2,3', help='fingerprint types to identify with')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--memory', action='store_true', help='peak memory of each stage (slower)')
+    parser.add_argument('--output', type=str, default='bench.json', help='json file of the results')
+    args = parser.parse_args()
+
+    results = run(args.songs, args.seconds, args.snippets, args.snippet_seconds, args.framerate,
+                  args.noise, tuple(int(x) for x in args.types.split(',')), args.seed, args.memory)
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+
+    print("%-22s %8s %10s %10s %10s %12s" % ("stage", "count", "p50 ms", "p90 ms", "p99 ms", "x realtime"))
+    for name, stage in results["stages"].items():
+        print("%-22s %8s %10.2f %10.2f %10.2f %12s" % (
+            name, stage["count"], stage["p50"] * 1000, stage["p90"] * 1000, stage["p99"] * 1000,
+            "%.0f" % stage["audio_per_second"] if stage.get("audio_per_second") else "-"))
+    for name, accuracy in results["accuracy"].items():
+        print("%s accuracy: %s" % (name, accuracy))
+    print("peak memory: %.0f MB, results in %s" % (results["peak_rss_bytes"] / 1024**2, args.output))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
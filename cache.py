@@ -0,0 +1,101 @@
+# RUN THIS PROGRAM TO:
+# keep decoded audio and fingerprints on disk between runs, so
+# ingesting again (other settings, new fingerprint variants, a
+# rebuilt database) does not decode and analyze the library again
+
+# HOW IT WORKS
+# + an entry is a directory of .npy files in the cache directory
+#   (FREEZAM_CACHE, None to disable the cache)
+# + entries are named after the content (sha1) of the audio file,
+#   see convert.stat, and for fingerprints after the settings too
+# + "pcm" entries hold the decoded samples, "features" entries the
+#   output of fun.compute_fingerprints
+# + arrays are memory-mapped when read
+# + at most FREEZAM_CACHE_SIZE bytes (default 2 GB): the least
+#   recently used entries are removed first, reading an entry
+#   marks it as used
+# + entries are written to a temporary directory and renamed, so
+#   worker processes can share the cache
+
+
+import os
+import json
+import uuid
+import shutil
+import hashlib
+import logging
+import numpy as np
+
+
+log = logging.getLogger(__name__)
+
+# cache directory, None to disable the cache
+CACHE = os.environ.get("FREEZAM_CACHE")
+# size limit of the cache (bytes)
+LIMIT = int(os.environ.get("FREEZAM_CACHE_SIZE", 2 * 1024**3))
+# bump when the layout of the entries or the analysis changes
+FORMAT = 1
+
+
+def key(kind, digest, settings=None):
+    """ name of an entry: kind, content of the file, and settings """
+    name = "%s_%s" % (kind, digest)
+    if settings is not None:
+        params = json.dumps([FORMAT, settings], sort_keys=True)
+        name += "_" + hashlib.sha1(params.encode()).hexdigest()[:16]
+    return name
+
+
+def get(name, names):
+    """ memory-map the arrays of an entry, None if missing """
+    if CACHE is None:
+        return None
+    path = os.path.join(CACHE, name)
+    try:
+        arrays = [np.load(os.path.join(path, field + ".npy"), mmap_mode="r") for field in names]
+        # most recently used
+        os.utime(path)
+    except (OSError, ValueError):
+        return None
+    log.info("%s read from cache", name)
+
+    return arrays
+
+
+def put(name, names, arrays):
+    """ save the arrays of an entry, then evict old entries """
+    if CACHE is None:
+        return
+    path = os.path.join(CACHE, name)
+    tmp = os.path.join(CACHE, ".tmp_" + uuid.uuid4().hex)
+    os.makedirs(tmp)
+    for field, array in zip(names, arrays):
+        np.save(os.path.join(tmp, field + ".npy"), np.asarray(array))
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        # written meanwhile by another process
+        shutil.rmtree(tmp, ignore_errors=True)
+        return
+    log.info("%s saved to cache", name)
+    evict(CACHE, LIMIT)
+
+
+def evict(cache, limit):
+    """ remove the least recently used entries above the size limit """
+    entries = []
+    for entry in os.scandir(cache):
+        if not entry.is_dir() or entry.name.startswith(".tmp_"):
+            continue
+        try:
+            size = sum(file.stat().st_size for file in os.scandir(entry.path))
+            entries.append((entry.stat().st_mtime, size, entry.path))
+        except OSError:
+            continue
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= limit:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        log.info("%s evicted from cache", os.path.basename(path))
@@ -0,0 +1,134 @@
+# RUN THIS PROGRAM TO:
+# keep the fingerprints of all songs in memory for identification
+
+# HOW IT WORKS
+# + load() reads fingerprints (ver.1 or ver.2) of the whole catalog
+#   once per process, as contiguous float32 arrays, in one query
+#   (see database.select_fingerprints)
+# + songs[i] owns rows offsets[i] to offsets[i+1] of every array
+# + reloaded when the catalog changes, see database.select_stamp
+# + optionally saved as .npy files in a snapshot directory, and
+#   memory-mapped from there by the next process (warm start)
+
+
+import os
+import json
+import logging
+import collections
+import numpy as np
+import database as d
+import metrics
+
+
+log = logging.getLogger(__name__)
+
+Catalog = collections.namedtuple(
+    "Catalog", "stamp songs offsets song_ids centers records")
+Catalog.__doc__ = """ fingerprints of all songs
+
++ stamp (tuple) - database.select_stamp() when loaded
++ songs (array) - song_id of each song
++ offsets (array) - first row of each song, and number of rows
++ song_ids (array) - song_id of each row (window)
++ centers (array) - center of each window in its song (seconds)
++ records (array) - fingerprint of each window, one per row
+"""
+
+# snapshot directory, None to keep catalogs in memory only
+SNAPSHOT = os.environ.get("FREEZAM_SNAPSHOT")
+
+# (version) -> (database.generation, Catalog)
+_cache = {}
+
+
+def load(conn, version, snapshot=SNAPSHOT):
+    """ fingerprints (ver.1 or ver.2) of all songs, see Catalog
+
+    Params
+    + version (int) - 1 or 2, fingerprint method
+    + snapshot (str) - directory to read/save a snapshot, or None
+    """
+    stamp = d.select_stamp(conn)
+    cached = _cache.get(version)
+    if cached is not None and cached[0] == d.generation and cached[1].stamp == stamp:
+        return cached[1]
+
+    catalog = None
+    if snapshot is not None:
+        catalog = read_snapshot(snapshot, version, stamp)
+    if catalog is None:
+        catalog = read_database(conn, version, stamp)
+        if snapshot is not None:
+            write_snapshot(snapshot, version, catalog)
+    _cache[version] = (d.generation, catalog)
+
+    return catalog
+
+
+def rows(catalog, songs):
+    """ rows of the windows of some songs (song_ids) """
+    first = np.searchsorted(catalog.songs, songs)
+    ranges = [np.arange(catalog.offsets[i], catalog.offsets[i+1]) for i in first]
+
+    return np.concatenate(ranges) if ranges else np.zeros(0, dtype=np.int64)
+
+
+def invalidate():
+    """ forget the catalogs loaded by this process """
+    _cache.clear()
+
+
+@metrics.timed("catalog.read_database")
+def read_database(conn, version, stamp):
+    """ read fingerprints of all songs from the database """
+    songs = []
+    centers = []
+    records = []
+    for song_id, center, fingerprints in d.select_fingerprints(conn, version):
+        if len(fingerprints):
+            songs.append(song_id)
+            centers.append(center)
+            records.append(fingerprints)
+    lengths = [len(r) for r in records]
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    songs = np.array(songs, dtype=np.int64)
+    song_ids = np.repeat(songs, lengths)
+    centers = np.concatenate(centers) if centers else np.zeros(0, dtype=np.float32)
+    shape = (0,) if version == 1 else (0, 0)
+    records = np.concatenate(records) if records else np.zeros(shape, dtype=np.float32)
+    log.info("%s fingerprints (ver.%s) of %s songs loaded from database", len(records), version, len(songs))
+
+    return Catalog(stamp, songs, offsets, song_ids, centers, records)
+
+
+def snapshot_path(snapshot, version, name):
+    """ file of one array of a snapshot """
+    return os.path.join(snapshot, "v%s_%s.npy" % (version, name))
+
+
+def read_snapshot(snapshot, version, stamp):
+    """ memory-map a snapshot, None if missing or out of date """
+    try:
+        with open(os.path.join(snapshot, "v%s_stamp.json" % version)) as file:
+            if tuple(json.load(file)) != stamp:
+                return None
+        arrays = {name: np.load(snapshot_path(snapshot, version, name), mmap_mode="r")
+                  for name in Catalog._fields[1:]}
+    except (OSError, ValueError):
+        return None
+    log.info("fingerprints (ver.%s) mapped from snapshot", version)
+
+    return Catalog(stamp, **arrays)
+
+
+def write_snapshot(snapshot, version, catalog):
+    """ save a catalog as .npy files, the stamp is written last """
+    os.makedirs(snapshot, exist_ok=True)
+    stamp = os.path.join(snapshot, "v%s_stamp.json" % version)
+    if os.path.exists(stamp):
+        os.remove(stamp)
+    for name in Catalog._fields[1:]:
+        np.save(snapshot_path(snapshot, version, name), getattr(catalog, name))
+    with open(stamp, "w") as file:
+        json.dump(list(catalog.stamp), file)
+    log.info("fingerprints (ver.%s) saved to snapshot %s", version, snapshot)
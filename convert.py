@@ -1,33 +1,103 @@
 # RUN THIS PROGRAM TO:
 # 1.convert mp3 to wav
 # 2.extract mp3 metadata
+# 3.decode mp3 to samples, streamed block by block from ffmpeg
+# 4.stat files to find changes
 
-from pydub import AudioSegment
-import eyed3
+# pydub and eyed3 are imported by the functions using them, they
+# are slow to import and only needed to ingest mp3 files
 import os
+import hashlib
 import logging
+import subprocess
+import numpy as np
+import metrics
 
 log = logging.getLogger(__name__)
 
+# seconds of samples read from ffmpeg at a time
+BLOCK = 10
+
 
 def convert(infile):
     """convert mp3 to wav
     Param: infile(str): a mp3 file, like "music.mp3"
     Export: outfile: a wav file with the same name, like "music.wav"
     """
+    from pydub import AudioSegment
     try:
-        # format outfile name
-        filename = os.path.basename(infile)
-        outfile = "./music/wav/" + filename[:-3] + "wav"
         # export wav
         sound = AudioSegment.from_mp3(infile)
-        sound.export(outfile, format="wav")
+        export(infile, sound)
     except OSError:
-        log.Error("expected an mp3 file in the directory")
+        log.error("expected an mp3 file in the directory")
+
+
+def decode(infile, rate=None, keep_wav=False):
+    """decode mp3 to samples, without holding them all in memory
 
+    ffmpeg writes one channel of 16-bit samples at rate to a pipe,
+    read BLOCK seconds at a time: nothing is written to disk (unless
+    keep_wav) and memory does not grow with the length of the song
+
+    Param: infile(str): a mp3 file, like "music.mp3"
+    Param: rate(int): samples per second, None for the rate of the mp3
+    Param: keep_wav(bool): also write a wav in ./music/wav, like convert()
+    Return: framerate(int), blocks(iterator): samples of shape (n, 1)
+    """
+    from pydub import AudioSegment
+    if rate is None:
+        from pydub.utils import mediainfo
+        rate = int(mediainfo(infile)["sample_rate"])
+    command = [AudioSegment.converter, "-nostdin", "-v", "error", "-y", "-i", infile, "-vn"]
+    if keep_wav:
+        outfile = wav_path(infile)
+        os.makedirs(os.path.dirname(outfile), exist_ok=True)
+        command += ["-acodec", "pcm_s16le", "-f", "wav", outfile]
+    command += ["-acodec", "pcm_s16le", "-ac", "1", "-ar", str(rate), "-f", "s16le", "pipe:1"]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
 
+    return rate, samples(process, BLOCK * rate)
+
+
+def samples(process, block):
+    """16-bit samples written by ffmpeg to its stdout, block at a time
+
+    raise subprocess.CalledProcessError if ffmpeg fails
+    """
+    try:
+        for data in iter(lambda: process.stdout.read(block * 2), b""):
+            metrics.count("bytes_decoded", len(data))
+            yield np.frombuffer(data[:len(data) // 2 * 2], dtype="<i2").reshape(-1, 1)
+    except BaseException:
+        # not read to the end
+        process.kill()
+        raise
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, process.args)
+
+
+def export(infile, sound):
+    """export decoded audio as a wav with the same name in ./music/wav"""
+    outfile = wav_path(infile)
+    os.makedirs(os.path.dirname(outfile), exist_ok=True)
+    sound.export(outfile, format="wav")
+
+
+def wav_path(infile):
+    """the wav of a mp3 in ./music/wav, same name"""
+    # format outfile name
+    filename = os.path.basename(infile)
+    return "./music/wav/" + filename[:-3] + "wav"
+
+
+@metrics.timed("convert.meta")
 def meta(infile):
     """ get metadata (title,artist,etc) from mp3 """
+    import eyed3
     try:
         file = eyed3.load(infile)
         title = file.tag.title
@@ -39,6 +109,23 @@ def meta(infile):
         return tup
 
     except OSError:
-        log.Error("expected an mp3 file in the directory")
+        log.error("expected an mp3 file in the directory")
     except AttributeError:
-        log.Error('expected an mp3 file')
+        log.error('expected an mp3 file')
+
+
+@metrics.timed("convert.stat")
+def stat(infile):
+    """ get file info to find changed files
+    Param: infile(str): a file, like "music.mp3"
+    Return: (address, size, mtime, digest), address is the absolute
+    path, digest is the sha1 of the content
+    """
+    info = os.stat(infile)
+    sha1 = hashlib.sha1()
+    with open(infile, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            sha1.update(chunk)
+    metrics.count("bytes_read", info.st_size)
+
+    return os.path.abspath(infile), info.st_size, info.st_mtime, sha1.hexdigest()
@@ -1,44 +1,356 @@
 # RUN THIS PROGRAM TO:
 # construct database
 
-# TODO:
-# 1.fast search, hashing
+# BACKENDS
+# + sqlite (default) - an embedded database in a local file,
+#   no server, no network round-trips
+# + postgresql - the server given in credentials.py
+# choose one with the environment variable FREEZAM_BACKEND,
+# and the sqlite file with FREEZAM_DB
+#
+# SESSIONS
+# + Pool - a bounded pool of connections, for threads (server.py)
+#   each using its own connection at a time
+# + transaction(conn) - a block of writes committed at once, or rolled
+#   back together. blocks can be nested, the outermost one commits
+# + prepared(cur, ...) - hot queries are parsed once per connection:
+#   PREPARE/EXECUTE on postgresql, the statement cache on sqlite
+# + sqlite databases use write-ahead logging: a client identifying
+#   snippets reads while songs are being written
+
+
+import os
+import json
+import uuid
+import queue
+import sqlite3
+import threading
+import functools
+import contextlib
+import metrics
+
+
+BACKEND = os.environ.get("FREEZAM_BACKEND", "sqlite")
+SQLITE_PATH = os.environ.get("FREEZAM_DB", "./freezam.db")
+# connections of a Pool, and seconds to wait for a free one
+POOL_SIZE = int(os.environ.get("FREEZAM_POOL_SIZE", 8))
+POOL_TIMEOUT = float(os.environ.get("FREEZAM_POOL_TIMEOUT", 30))
+# compiled statements kept by each sqlite connection
+STATEMENTS = 256
+# songs fetched per round-trip when reading all fingerprints
+FETCH_SIZE = 256
+
+# postgresql syntax used in this module, and its sqlite equivalent
+SQLITE_SYNTAX = [
+    ("SERIAL PRIMARY KEY", "INTEGER PRIMARY KEY AUTOINCREMENT"),
+    ("NUMERIC ARRAY", "ARRAY"),
+    ("BYTEA", "BLOB"),
+    ("= ANY(%s)", "IN (SELECT value FROM json_each(%s))"),
+    ("%s", "?"),
+]
+
+# number of changes of the catalog made by this process
+generation = 0
+
+# fingerprints of a song are packed in one row, as float32 arrays
+# (numpy is imported by pack and unpack only: commands not touching
+# fingerprints, like list or remove, start faster without it),
+# FINGERPRINT_TABLE % name creates the table under a name, see migrate
+DTYPE = "float32"
+FINGERPRINT_TABLE = """CREATE TABLE IF NOT EXISTS %s (
+    song_id INT PRIMARY KEY REFERENCES music (song_id) ON DELETE CASCADE,
+    windows INT,
+    center BYTEA,
+    signature1 BYTEA,
+    signature2 BYTEA
+    )"""
+# version of the catalog, bumped by every write to it (see bump), and
+# never dropped: a database rebuilt with the same songs gets a new stamp
+REVISION_TABLE = """CREATE TABLE IF NOT EXISTS revision (
+    token TEXT,
+    version BIGINT
+    )"""
+# columns added since databases were first built: (table, column, type)
+NEW_COLUMNS = [
+    ("music", "size", "BIGINT"),
+    ("music", "mtime", "DOUBLE PRECISION"),
+    ("music", "digest", "TEXT"),
+]
+
+# sqlite stores arrays as json text
+sqlite3.register_adapter(list, json.dumps)
+sqlite3.register_converter("ARRAY", json.loads)
+
+
+class CountingCursor:
+    """ cursor counting database round-trips and rows, see metrics.py """
+
+    def execute(self, query, val=None):
+        metrics.count("db_queries")
+        return super().execute(query) if val is None else super().execute(query, val)
+
+    def executemany(self, query, val):
+        metrics.count("db_queries")
+        return super().executemany(query, val)
+
+    def fetchone(self):
+        row = super().fetchone()
+        metrics.count("db_rows_read", row is not None)
+        return row
+
+    def fetchmany(self, size):
+        rows = super().fetchmany(size)
+        metrics.count("db_rows_read", len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        metrics.count("db_rows_read", len(rows))
+        return rows
+
+
+class SQLiteCursor(CountingCursor, sqlite3.Cursor):
+    """ sqlite cursor speaking the postgresql syntax of this module """
+
+    def execute(self, query, val=()):
+        return super().execute(to_sqlite(query), val)
+
+    def executemany(self, query, val):
+        return super().executemany(to_sqlite(query), val)
+
+
+class Session:
+    """ state of a connection: open transaction blocks, see transaction(),
+    and statements prepared so far, see prepared() """
+    depth = 0
+    prepared = frozenset()
+
+
+class SQLiteConnection(Session, sqlite3.Connection):
+    """ sqlite connection handing out SQLiteCursor """
+
+    def cursor(self, factory=SQLiteCursor):
+        return super().cursor(factory)
+
+
+@functools.lru_cache(maxsize=STATEMENTS)
+def to_sqlite(query):
+    """ translate a postgresql query to sqlite """
+    for pg, lite in SQLITE_SYNTAX:
+        query = query.replace(pg, lite)
+    return query
+
+
+def connect(backend=None, path=None):
+    """ connect to the database
+
+    Params
+    + backend (str) - "sqlite" or "postgresql", default BACKEND
+    + path (str) - sqlite database file, default SQLITE_PATH
+    """
+    backend = backend or BACKEND
+    if backend == "sqlite":
+        conn = sqlite3.connect(
+            path or SQLITE_PATH,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            factory=SQLiteConnection,
+            # a connection may be handed to another thread, see Pool
+            check_same_thread=False,
+            cached_statements=STATEMENTS
+        )
+        # needed for ON DELETE CASCADE
+        conn.execute("PRAGMA foreign_keys = ON")
+        # readers do not wait for writers
+        conn.execute("PRAGMA journal_mode = WAL")
+        return conn
+    elif backend == "postgresql":
+        import psycopg2
+        from credentials import DB_USER, DB_PASSWORD
+        return psycopg2.connect(
+            host="sculptor.stat.cmu.edu",
+            database=DB_USER,
+            user=DB_USER,
+            password=DB_PASSWORD,
+            connection_factory=pg_connection(),
+            cursor_factory=pg_cursor()
+        )
+    else:
+        raise ValueError("expected sqlite or postgresql backend")
+
+
+@functools.lru_cache(maxsize=None)
+def pg_cursor():
+    """ psycopg2 cursor counting round-trips, see CountingCursor """
+    from psycopg2.extensions import cursor
+    return type("PGCursor", (CountingCursor, cursor), {})
+
+
+@functools.lru_cache(maxsize=None)
+def pg_connection():
+    """ psycopg2 connection keeping its Session """
+    from psycopg2.extensions import connection
+    return type("PGConnection", (Session, connection), {})
+
+
+class Pool:
+    """ database connections shared by threads
+
+    a connection is used by one thread at a time, and given back to
+    the pool when done. at most size connections are open, a thread
+    waits up to timeout seconds for one to be given back
+    """
+
+    def __init__(self, connect=connect, size=POOL_SIZE, timeout=POOL_TIMEOUT):
+        self.connect = connect
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+
+    def get(self):
+        if not self.slots.acquire(timeout=self.timeout):
+            raise TimeoutError("no free database connection after %s s" % self.timeout)
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return self.connect()
+        except Exception:
+            self.slots.release()
+            raise
+
+    def put(self, conn):
+        self.idle.put(conn)
+        self.slots.release()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """ a connection of the pool for a block, rolled back on error """
+        conn = self.get()
+        try:
+            yield conn
+        except Exception:
+            try:
+                conn.rollback()
+            except Exception:
+                # broken connection, open a new one next time
+                conn.close()
+                self.slots.release()
+                raise
+            self.put(conn)
+            raise
+        self.put(conn)
+
+    def close(self):
+        while not self.idle.empty():
+            self.idle.get_nowait().close()
+
+
+@contextlib.contextmanager
+def transaction(conn):
+    """ a cursor to run a block of writes as one transaction
+
+    commit at the end of the block, or roll everything back if it
+    raises. blocks can be nested: only the outermost one commits, so
+    several writes (like songs and their fingerprints) can be grouped
+    """
+    depth = conn.depth
+    conn.depth = depth + 1
+    try:
+        yield conn.cursor()
+    except Exception:
+        conn.depth = depth
+        if depth == 0:
+            conn.rollback()
+        raise
+    conn.depth = depth
+    if depth == 0:
+        conn.commit()
+
+
+def prepared(cur, name, query, val):
+    """ execute a hot query, parsed and planned once per connection
+
+    sqlite keeps the compiled statements of a connection (STATEMENTS),
+    postgresql needs PREPARE once, then EXECUTE
+    """
+    if isinstance(cur, sqlite3.Cursor):
+        return cur.execute(query, val)
+    prepare, execute = to_prepared(name, query)
+    if name not in cur.connection.prepared:
+        cur.execute(prepare)
+        cur.connection.prepared = cur.connection.prepared | {name}
+    return cur.execute(execute, val)
+
+
+@functools.lru_cache(maxsize=None)
+def to_prepared(name, query):
+    """ PREPARE and EXECUTE statements of a postgresql query """
+    parts = query.split("%s")
+    body = parts[0] + "".join("$%s%s" % (i, part) for i, part in enumerate(parts[1:], 1))
+    execute = "EXECUTE %s" % name
+    if len(parts) > 1:
+        execute += " (%s)" % ", ".join(["%s"] * (len(parts) - 1))
+    return "PREPARE %s AS %s" % (name, body), execute
 
 
-import psycopg2
-from credentials import DB_USER, DB_PASSWORD
+def changed():
+    """ note a change of the catalog, see select_stamp """
+    global generation
+    generation += 1
 
 
-# connect to database
-conn = psycopg2.connect(
-    host="sculptor.stat.cmu.edu",
-    database=DB_USER,
-    user=DB_USER,
-    password=DB_PASSWORD
-)
+def __getattr__(name):
+    """ connect on first use of database.conn, not at import """
+    if name == "conn":
+        globals()["conn"] = connect()
+        return globals()["conn"]
+    raise AttributeError("module 'database' has no attribute %r" % name)
 
 
 def test_connect(conn):
-    """ check connection to postgresql """
-    if conn.closed == 0:
-        print('Connected to MySQL database')
-    else:
+    """ check connection to database """
+    try:
+        conn.cursor().execute('SELECT 1')
+        print('Connected to database')
+    except Exception:
         print('Unable to connect')
 
 
-def create_table(conn):
-    """ create two tables: music & fingerprint
+def create_table(conn, reset=True):
+    """ create the tables: music, fingerprint, hash & settings
+
+    reset=False keeps the tables and songs already there, and only
+    creates what is missing (incremental ingest, see fun.sync)
 
     MUSIC
     + store song info (title, artist, album, etc.)
     + indicate whether a song is fingerprinted or not
     + fingerprinted default = 0, update when completed
+    + file of the song: address (path), size, mtime and digest
+      (sha1 of the content), to find new and changed files
 
     FINGERPRINT
     + store all info required for fingerprint (hash, windows, etc)
+    + one row per song: center, signature1 and signature2 of all its
+      windows packed as float32 bytes, read back with np.frombuffer
     + foreign key song_id to link two tables
     + delete a song in music = delete all same song_id in fingerprint
 
+    HASH
+    + store peak-pair hashes (ver.3) and the window of their anchor
+    + indexed on hash, a lookup costs the same for any library size
+    + foreign key song_id, same as fingerprint
+
+    SETTINGS
+    + analysis settings (sample rate, windows) used to fingerprint
+    + snippets must be analyzed the same way to match
+
+    REVISION
+    + a random token and a version of the catalog, see select_stamp
+    + kept on reset, a rebuild is a new version. without reset, the
+      version only changes if columns are added (see add_columns)
+
     JUSTIFICATION
     WHY TWO TABLES?
     + we'll mostly be working with fingerprint table (calc windows, etc)
@@ -49,8 +361,11 @@ def create_table(conn):
     """
     cur = conn.cursor()
 
-    cur.execute("DROP TABLE IF EXISTS fingerprint")
-    cur.execute("DROP TABLE IF EXISTS music")
+    if reset:
+        cur.execute("DROP TABLE IF EXISTS settings")
+        cur.execute("DROP TABLE IF EXISTS hash")
+        cur.execute("DROP TABLE IF EXISTS fingerprint")
+        cur.execute("DROP TABLE IF EXISTS music")
 
     cur.execute(
         """CREATE TABLE IF NOT EXISTS music (
@@ -60,89 +375,262 @@ def create_table(conn):
             album TEXT,
             address TEXT,
             url TEXT,
-            fingerprinted INT default 0
+            fingerprinted INT default 0,
+            size BIGINT,
+            mtime DOUBLE PRECISION,
+            digest TEXT
             )""")
+    cur.execute(FINGERPRINT_TABLE % "fingerprint")
     cur.execute(
-        """CREATE TABLE IF NOT EXISTS fingerprint (
-            sig_id SERIAL PRIMARY KEY,
+        """CREATE TABLE IF NOT EXISTS hash (
             song_id INT REFERENCES music (song_id) ON DELETE CASCADE,
-            center INT,
-            signature1 NUMERIC,
-            signature2 NUMERIC ARRAY
+            hash BIGINT,
+            anchor INT
+            )""")
+    cur.execute(
+        """CREATE TABLE IF NOT EXISTS settings (
+            name TEXT PRIMARY KEY,
+            value TEXT
             )""")
+    if reset:
+        bump(cur)
 
     conn.commit()
+    if reset:
+        changed()
+    else:
+        add_columns(conn)
+    fast_search(conn)
 
 
-def add_song(tup, conn):
-    """ add song to music """
-    if isinstance(tup, tuple) or isinstance(tup, list):
+def bump(cur):
+    """ note a write to the catalog, in the same transaction, see select_stamp """
+    # databases built before the revision table
+    cur.execute(REVISION_TABLE)
+    cur.execute('UPDATE revision SET version = version + 1')
+    if cur.rowcount == 0:
+        cur.execute('INSERT INTO revision (token, version) VALUES (%s, 1)', (uuid.uuid4().hex,))
+
+
+def add_columns(conn):
+    """ add NEW_COLUMNS to a database built without them """
+    for table, column, type in NEW_COLUMNS:
         cur = conn.cursor()
-        query = "INSERT INTO music (title, artist, album) VALUES (%s, %s, %s)"
-        cur.execute(query, tup)
-        conn.commit()
+        try:
+            cur.execute('SELECT %s FROM %s LIMIT 1' % (column, table))
+        except Exception:
+            conn.rollback()
+            with transaction(conn) as cur:
+                cur.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table, column, type))
+                bump(cur)
+            changed()
+
+
+def add_song(tup, conn, file=None):
+    """ add song to music
+
+    + file (tuple) - (address, size, mtime, digest), see convert.stat
+    """
+    if isinstance(tup, tuple) or isinstance(tup, list):
+        with transaction(conn) as cur:
+            if file is None:
+                query = "INSERT INTO music (title, artist, album) VALUES (%s, %s, %s)"
+                prepared(cur, "add_song", query, tuple(tup))
+            else:
+                query = """INSERT INTO music (title, artist, album, address, size, mtime, digest)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)"""
+                prepared(cur, "add_song_file", query, tuple(tup) + tuple(file))
+        changed()
     else:
         print("tup should be a tuple or list")
 
 
-def add_fingerprint(filename, t, fingerprints1, fingerprints2, conn):
-    """ add fingerprints (ver.1 & ver.2) of a song"""
-    query = 'INSERT INTO fingerprint (song_id, center, signature1, signature2) VALUES (%s,%s,%s,%s)'
-    song_id = select_songid(filename, conn)
-    for i in range(len(t)):
-        val = (song_id, t[i], fingerprints1[i], list(fingerprints2[i]))
-        cur = conn.cursor()
-        cur.execute(query, val)
-        conn.commit()
+def add_fingerprint(filename, t, fingerprints1, fingerprints2, conn,
+                    hashes=(), anchors=()):
+    """ add fingerprints (ver.1, ver.2 & ver.3) of a song, see add_fingerprints """
+    add_fingerprints([(filename, t, fingerprints1, fingerprints2, hashes, anchors)], conn)
+
+
+@metrics.timed("database.add_fingerprints")
+def add_fingerprints(batch, conn):
+    """ add fingerprints of a batch of songs in one transaction
+
+    Param: batch (list) - one tuple per song:
+    (filename, t, fingerprints1, fingerprints2, hashes, anchors)
+
+    WHAT IT DOES
+    + write all windows of a song in one row, hashes in bulk
+    + set fingerprinted = 1 for these songs
+    + commit once, or roll back everything on error (see transaction,
+      songs can be added in the same transaction)
+    """
+    songs = []
+    pairs = []
+    song_ids = []
+    for filename, t, fingerprints1, fingerprints2, hashes, anchors in batch:
+        song_id = select_songid(filename, conn)
+        song_ids.append((song_id,))
+        songs.append((song_id, len(t), pack(t), pack(fingerprints1), pack(fingerprints2)))
+        pairs.extend((song_id, int(h), int(a)) for h, a in zip(hashes, anchors))
+    with transaction(conn) as cur:
+        insert_many(cur, 'fingerprint (song_id, windows, center, signature1, signature2)', songs)
+        insert_many(cur, 'hash (song_id, hash, anchor)', pairs)
+        cur.executemany('UPDATE music SET fingerprinted = 1 where song_id = %s', song_ids)
+        bump(cur)
+    changed()
+
+
+def insert_many(cur, table, rows):
+    """ insert many rows with one statement per page instead of one per row
+
+    Params
+    + table (str) - table name and columns, like "hash (song_id, hash)"
+    + rows (list) - tuples of values
+    """
+    if not rows:
+        return
+    metrics.count("db_rows_written", len(rows))
+    if isinstance(cur, sqlite3.Cursor):
+        values = ",".join(["%s"] * len(rows[0]))
+        cur.executemany('INSERT INTO %s VALUES (%s)' % (table, values), rows)
+    else:
+        from psycopg2.extras import execute_values
+        execute_values(cur, 'INSERT INTO %s VALUES %%s' % table, rows, page_size=1000)
+
+
+def pack(values):
+    """ pack an array as float32 bytes """
+    import numpy as np
+    blob = np.ascontiguousarray(values, dtype=DTYPE).tobytes()
+    metrics.count("db_bytes_written", len(blob))
+    return blob
+
+
+def unpack(blob, windows):
+    """ unpack float32 bytes to an array with one row per window, no copy """
+    import numpy as np
+    values = np.frombuffer(blob, dtype=DTYPE)
+    metrics.count("db_bytes_read", values.nbytes)
+    return values.reshape(windows, -1) if windows else values.reshape(0, 0)
+
+
+def migrate(conn):
+    """ convert a fingerprint table with one row per window and NUMERIC
+    signatures (databases built before packed rows) to one row per song
+
+    the packed rows go to a new table, which replaces the old one: on
+    postgresql a renamed table keeps the name of its primary key index
+    (fingerprint_pkey), so the old table cannot be renamed first
+
+    Return
+    + boolean, True if a table was converted
+    """
+    cur = conn.cursor()
+    try:
+        cur.execute('SELECT sig_id FROM fingerprint LIMIT 1')
+    except Exception:
+        conn.rollback()
+        return False
+
+    with transaction(conn) as cur:
+        cur.execute('DROP TABLE IF EXISTS fingerprint_new')
+        cur.execute(FINGERPRINT_TABLE % "fingerprint_new")
+        cur.execute(
+            """SELECT song_id, center, signature1, signature2
+            FROM fingerprint ORDER BY song_id, center""")
+        records = cur.fetchall()
+        songs = []
+        start = 0
+        for i in range(1, len(records) + 1):
+            if i == len(records) or records[i][0] != records[start][0]:
+                rows = records[start:i]
+                songs.append((
+                    rows[0][0], len(rows),
+                    pack([float(row[1]) for row in rows]),
+                    pack([float(row[2]) for row in rows]),
+                    pack([list(map(float, row[3])) for row in rows])))
+                start = i
+        insert_many(cur, 'fingerprint_new (song_id, windows, center, signature1, signature2)', songs)
+        cur.execute('DROP TABLE fingerprint')
+        cur.execute('ALTER TABLE fingerprint_new RENAME TO fingerprint')
+        bump(cur)
+    changed()
+
+    return True
+
+
+def add_settings(settings, conn):
+    """ record analysis settings, a dict of dicts like analyze.SETTINGS """
+    with transaction(conn) as cur:
+        cur.execute('DELETE FROM settings')
+        val = [(name, json.dumps(value)) for name, value in settings.items()]
+        cur.executemany('INSERT INTO settings (name, value) VALUES (%s, %s)', val)
+        bump(cur)
+    changed()
 
 
 def drop_song(title, conn):
     """ delete song from music """
-    cur = conn.cursor()
-    query = 'DELETE FROM music WHERE title = %s'
-    cur.execute(query, (title,))
-    conn.commit()
+    with transaction(conn) as cur:
+        cur.execute('DELETE FROM music WHERE title = %s', (title,))
+        bump(cur)
+    changed()
+
+
+def drop_songs(song_ids, conn):
+    """ delete songs (and their fingerprints) by song_id, at once """
+    if not song_ids:
+        return
+    with transaction(conn) as cur:
+        cur.execute('DELETE FROM music WHERE song_id = ANY(%s)', ([int(i) for i in song_ids],))
+        bump(cur)
+    changed()
 
 
 def drop_unfingerprinted(conn):
     """ delete unfingerprinted song from music """
-    cur = conn.cursor()
-    query = 'DELETE FROM music WHERE fingerprinted = 0'
-    cur.execute(query)
-    conn.commit()
+    with transaction(conn) as cur:
+        cur.execute('DELETE FROM music WHERE fingerprinted = 0')
+        bump(cur)
+    changed()
 
 
 def drop_duplicate(conn):
     """ delete duplicate rows from music """
-    cur = conn.cursor()
-    cur.execute(
-        """DELETE FROM music a USING music b
-        WHERE a.song_id > b.song_id
-        AND a.title = b.title
-        """)
-    conn.commit()
+    with transaction(conn) as cur:
+        cur.execute(
+            """DELETE FROM music WHERE song_id NOT IN
+            (SELECT MIN(song_id) FROM music GROUP BY title)
+            """)
+        bump(cur)
+    changed()
 
 
 def update_fingerprinted(song_id, conn):
     """ set fingerprinted = 1 when done """
-    cur = conn.cursor()
-    query = 'UPDATE music SET fingerprinted = 1 where song_id = %s'
-    cur.execute(query, (song_id,))
-    conn.commit()
+    with transaction(conn) as cur:
+        cur.execute('UPDATE music SET fingerprinted = 1 where song_id = %s', (song_id,))
+        bump(cur)
+    changed()
+
+
+def update_file(song_id, file, conn):
+    """ record the file of a song: (address, size, mtime, digest) """
+    with transaction(conn) as cur:
+        query = 'UPDATE music SET address = %s, size = %s, mtime = %s, digest = %s where song_id = %s'
+        cur.execute(query, tuple(file) + (song_id,))
 
 
 def update_artist(title, artist, conn):
     """ update metadata: song artist """
-    cur = conn.cursor()
-    cur.execute('UPDATE music SET artist = %s where title = %s', (artist, title))
-    conn.commit()
+    with transaction(conn) as cur:
+        cur.execute('UPDATE music SET artist = %s where title = %s', (artist, title))
 
 
 def update_album(title, album, conn):
     """ update metadata: song album """
-    cur = conn.cursor()
-    cur.execute('UPDATE music SET album = %s where title = %s', (album, title))
-    conn.commit()
+    with transaction(conn) as cur:
+        cur.execute('UPDATE music SET album = %s where title = %s', (album, title))
 
 
 def select_songid(filename, conn):
@@ -151,7 +639,7 @@ def select_songid(filename, conn):
     query = 'SELECT song_id from music WHERE title = %s'
     # get rid of the suffix (.wav) in filename
     val = (filename[:-4],)
-    cur.execute(query, val)
+    prepared(cur, "select_songid", query, val)
     # the output should be a single str
     records = cur.fetchall()
     # convert to str
@@ -167,6 +655,32 @@ def select_title(song_id, conn):
     return records[0][0]
 
 
+@metrics.timed("database.select_titles")
+def select_titles(song_ids, conn):
+    """ select the titles of many songs at once
+
+    Return
+    + dict, song_id -> title
+    """
+    cur = conn.cursor()
+    query = 'SELECT song_id, title from music WHERE song_id = ANY(%s)'
+    prepared(cur, "select_titles", query, ([int(i) for i in set(song_ids)],))
+    records = cur.fetchall()
+    return dict(records)
+
+
+def select_files(conn):
+    """ select the files of all songs
+
+    Return
+    + list of (song_id, title, address, size, mtime, digest, fingerprinted)
+    """
+    cur = conn.cursor()
+    cur.execute('SELECT song_id, title, address, size, mtime, digest, fingerprinted FROM music')
+    records = cur.fetchall()
+    return records
+
+
 def select_max_song_id(conn):
     """ select the maximum song_id (to loop over all songs) """
     cur = conn.cursor()
@@ -176,25 +690,115 @@ def select_max_song_id(conn):
 
 
 def select_fingerprint1(conn, song_id):
-    """ select all fingerprints (ver.1) of a song """
+    """ select all fingerprints (ver.1) of a song, one per window """
     cur = conn.cursor()
-    cur.execute('select signature1 from fingerprint where song_id=%s', (song_id,))
+    query = 'select windows, signature1 from fingerprint where song_id=%s'
+    prepared(cur, "select_fingerprint1", query, (song_id,))
     records = cur.fetchall()
-     # convert decimal tuple to float num
-    records = [float(elem[0]) for elem in records]
-    return records
+    if not records:
+        return unpack(b"", 0).ravel()
+    return unpack(records[0][1], records[0][0]).ravel()
 
 
 def select_fingerprint2(conn, song_id):
-    """ select all fingerprints (ver.2) of a song """
+    """ select all fingerprints (ver.2) of a song, one row per window """
     cur = conn.cursor()
-    cur.execute('select signature2 from fingerprint where song_id=%s', (song_id,))
+    query = 'select windows, signature2 from fingerprint where song_id=%s'
+    prepared(cur, "select_fingerprint2", query, (song_id,))
+    records = cur.fetchall()
+    if not records:
+        return unpack(b"", 0)
+    return unpack(records[0][1], records[0][0])
+
+
+def select_fingerprints(conn, version, size=FETCH_SIZE):
+    """ fingerprints (ver.1 or ver.2) of all fingerprinted songs, in one query
+
+    rows are fetched size songs at a time, from a server-side cursor
+    on postgresql, so memory and round-trips do not grow with the
+    number of songs
+
+    Yield
+    + (song_id, centers, fingerprints) of each song, by song_id
+    """
+    query = """SELECT f.song_id, f.windows, f.center, f.signature%s
+    FROM fingerprint f JOIN music m ON m.song_id = f.song_id
+    WHERE m.fingerprinted = 1
+    ORDER BY f.song_id""" % version
+    if isinstance(conn, sqlite3.Connection):
+        cur = conn.cursor()
+    else:
+        # named cursor: rows stay on the server until fetched
+        cur = conn.cursor(name="select_fingerprints")
+    cur.execute(query)
+    try:
+        while True:
+            rows = cur.fetchmany(size)
+            if not rows:
+                break
+            for song_id, windows, center, signature in rows:
+                fingerprints = unpack(signature, windows)
+                yield song_id, unpack(center, windows).ravel(), (
+                    fingerprints.ravel() if version == 1 else fingerprints)
+    finally:
+        cur.close()
+
+
+@metrics.timed("database.select_hash")
+def select_hash(conn, hashes):
+    """ select all (song_id, hash, anchor) matching a list of hashes """
+    cur = conn.cursor()
+    query = 'SELECT song_id, hash, anchor FROM hash WHERE hash = ANY(%s)'
+    prepared(cur, "select_hash", query, ([int(h) for h in set(hashes)],))
     records = cur.fetchall()
-    # convert f1 from decimal tuple to float list
-    records = [list(map(float, list(elem[0]))) for elem in records]
     return records
 
 
+def select_settings(conn):
+    """ select analysis settings
+
+    Return
+    + dict, empty if none recorded yet
+    + None if the database predates the settings table
+    """
+    cur = conn.cursor()
+    try:
+        cur.execute('SELECT name, value FROM settings')
+    except Exception:
+        conn.rollback()
+        return None
+    records = cur.fetchall()
+    return {name: json.loads(value) for name, value in records}
+
+
+def select_stamp(conn):
+    """ a stamp of the catalog, it changes whenever a song is added,
+    removed or fingerprinted, or the database is rebuilt, by this
+    process or any other
+
+    Return
+    + tuple, (database, token, version, number of songs, max song_id,
+      fingerprinted songs), see bump
+    """
+    if isinstance(conn, sqlite3.Connection):
+        cur = conn.execute('PRAGMA database_list')
+        name = os.path.abspath(cur.fetchall()[0][2] or ':memory:')
+    else:
+        name = conn.dsn
+    cur = conn.cursor()
+    try:
+        cur.execute('SELECT token, version FROM revision')
+        revision = cur.fetchone() or (None, 0)
+    except Exception:
+        # never written since the revision table
+        conn.rollback()
+        revision = (None, 0)
+        cur = conn.cursor()
+    cur.execute('SELECT COUNT(*), MAX(song_id), SUM(fingerprinted) FROM music')
+    records = cur.fetchall()
+    return (name,) + tuple(revision) + tuple(records[0])
+
+
 def list_all_songs(conn):
     """ list all song titles in database """
     cur = conn.cursor()
@@ -206,9 +810,14 @@ def list_all_songs(conn):
 
 
 def fast_search(conn):
-    """ create Generalized Inverted Indexes (GIN) for fast search,
-    good for searching k-nearest neighbors"""
-    pass
+    """ create an index on peak-pair hashes for fast search
+
+    identify (ver.3) looks up the hashes of a snippet, the index
+    keeps each lookup logarithmic in the number of stored hashes
+    """
+    cur = conn.cursor()
+    cur.execute('CREATE INDEX IF NOT EXISTS hash_index ON hash (hash)')
+    conn.commit()
 
 
 # TRASH BELOW
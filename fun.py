@@ -14,17 +14,40 @@
 
 
 import os
+import csv
+import json
+import time
 import logging
+import functools
+import itertools
+import multiprocessing
+import numpy as np
 import analyze as a
 import convert as c
 import database as d
-from database import conn
+import cache
+import catalog
+import index
+import metrics
 
 
 log = logging.getLogger(__name__)
 
-
-def firststep(conn):
+# directory of the music library
+MUSIC = "./music/mp3"
+# number of songs written to the database per transaction
+BATCH_SIZE = 16
+# arrays of compute_fingerprints(), as saved in the cache
+FEATURES = ("t", "fingerprints1", "fingerprints2", "hashes", "anchors")
+# number of matches reported per snippet
+TOP = 5
+# lowest score of a match (share of the snippet agreeing with it),
+# per fingerprint type: a noisy snippet keeps a few percent of its
+# hashes (type 3) but random hashes agree on about 0.1 percent
+MIN_SCORE = {1: 0.1, 2: 0.1, 3: 0.003}
+
+
+def firststep(conn, jobs=None, keep_wav=False, settings=None):
     """ ingest a directory of music for database construction
 
     USAGE
@@ -36,150 +59,585 @@ def firststep(conn):
     + sql database contruction
     + read all mp3 files from a local dir
     + read metadata
-    + convert mp3 to wav
+    + decode mp3 as a stream of samples (and keep the wav if keep_wav)
     + compute spectrograms and fingerprints
     + record all info in the database
 
+    HOW IT WORKS
+    + jobs (int) worker processes decode and fingerprint the songs,
+      one per cpu by default
+    + this process is the only writer, it records the results in
+      the database as they come, several songs per transaction
+    + settings (dict) override analyze.SETTINGS, like
+      {"hash": {"window": 0.1}}, and are recorded in the database
+
     GOOD FOR
     + lazy guys like me who don't want to contruct db manually
     """
 
     # create tables if non-exist
     d.create_table(conn)
+    settings = {name: dict(value, **(settings or {}).get(name, {}))
+                for name, value in a.SETTINGS.items()}
+    d.add_settings(settings, conn)
     log.info("database created")
     # construct database
-    for file in os.listdir("./music/mp3"):
-        if file.endswith(".mp3"):
-            pathfile = "./music/mp3/" + file
-            # read metadata
-            tup = c.meta(pathfile)
-            d.add_song(tup, conn)
-            # convert mp3 to wav
-            c.convert(pathfile)
-    log.info('all metadata recorded in the database')
-    log.info('all audio converted to wav')
-
-    for file in os.listdir("./music/wav"):
-        if file.endswith(".wav"):
-            pathfile = "./music/wav/" + file
-            # compute spectrogram and fingerprints
-            framerate, f, t, spect = a.spectrogram(pathfile)
-            fingerprints1 = a.fingerprint(f, spect)
-            fingerprints2 = a.fingerprint2(f, spect, framerate)
-            song_id = d.select_songid(file, conn)
-            log.info('audio file no. %s recorded in the database', song_id)
-            # add fingerprints to database
-            d.add_fingerprint(file, t, fingerprints1, fingerprints2, conn)
-            # update fingerprinted status
-            d.update_fingerprinted(song_id, conn)
+    record(conn, list_music(), jobs, keep_wav, settings)
 
     print('Done! Please check out your database ❤')
 
 
-def add_single(conn, pathfile):
+def sync(conn, jobs=None, keep_wav=False):
+    """ bring the database up to date with ./music/mp3, incrementally
+
+    WHAT IT DOES
+    + ingest new files, changed files, and songs left unfingerprinted
+      (e.g. by a crash), with the settings of the database
+    + remove the songs (and fingerprints) of files gone from ./music/mp3
+    + unchanged files are not read: same size and mtime as recorded,
+      or, if only the mtime changed, the same content (sha1)
+    + songs of databases built before files were recorded are matched
+      by title, and their file recorded as it is now
+    + databases built before fingerprints were packed one row per song
+      are migrated first, see database.migrate
+
+    Return
+    + (int, int, int) - numbers of ingested, removed and unchanged songs
+    """
+    if d.migrate(conn):
+        log.info("fingerprints packed one row per song")
+    # before create_table adds an empty settings table: None if the
+    # database predates settings, its songs have LEGACY_SETTINGS
+    settings = d.select_settings(conn)
+    d.create_table(conn, reset=False)
+    if settings is None and d.select_files(conn):
+        d.add_settings(a.LEGACY_SETTINGS, conn)
+    settings = load_settings(conn)
+    pathfiles = list_music()
+
+    rows = d.select_files(conn)
+    # the same file however its path was written, see convert.stat
+    by_address = {os.path.abspath(row[2]): row for row in rows if row[2] is not None}
+    by_title = {row[1]: row for row in rows if row[2] is None}
+    todo = []
+    drop = []
+    unchanged = 0
+    for pathfile in pathfiles:
+        row = by_address.pop(os.path.abspath(pathfile), None)
+        if row is None:
+            row = by_title.pop(os.path.basename(pathfile)[:-4], None)
+            if row is not None and row[6]:
+                # fingerprinted before files were recorded
+                d.update_file(row[0], c.stat(pathfile), conn)
+                unchanged += 1
+                continue
+        if row is None:
+            todo.append(pathfile)
+            continue
+        if not row[6]:
+            # left unfingerprinted, start again
+            drop.append(row[0])
+            todo.append(pathfile)
+            continue
+        info = os.stat(pathfile)
+        if (row[3], row[4]) == (info.st_size, info.st_mtime):
+            unchanged += 1
+            continue
+        file = c.stat(pathfile)
+        if file[3] == row[5]:
+            # touched, same content
+            d.update_file(row[0], file, conn)
+            unchanged += 1
+            continue
+        drop.append(row[0])
+        todo.append(pathfile)
+    # files gone from the music directory
+    music = os.path.abspath(MUSIC)
+    gone = [row[0] for address, row in by_address.items() if os.path.dirname(address) == music]
+    log.info("%s songs to ingest, %s to remove, %s unchanged", len(todo), len(gone), unchanged)
+    d.drop_songs(drop + gone, conn)
+    # nothing changed: the catalog, its stamp and its index stay as they are
+    if todo:
+        record(conn, todo, jobs, keep_wav, settings)
+    elif gone:
+        index.build(conn)
+
+    print('Done! %s songs ingested, %s removed, %s unchanged ❤' % (len(todo), len(gone), unchanged))
+    return len(todo), len(gone), unchanged
+
+
+def list_music():
+    """ pathfiles of all mp3 in ./music/mp3 """
+    return [MUSIC + "/" + file for file in sorted(os.listdir(MUSIC)) if file.endswith(".mp3")]
+
+
+@metrics.timed("fun.record")
+def record(conn, pathfiles, jobs=None, keep_wav=False, settings=None):
+    """ ingest mp3 files and record them in the database, see firststep """
+    jobs = jobs or os.cpu_count() or 1
+    log.info("ingesting %s songs with %s worker(s)", len(pathfiles), jobs)
+
+    # write several songs per transaction
+    batch = []
+    results = ingest(pathfiles, jobs, keep_wav, settings)
+    for i, result in enumerate(results, 1):
+        batch.append(result)
+        if len(batch) == BATCH_SIZE:
+            record_batch(conn, batch)
+            batch = []
+        log.info('audio file %s fingerprinted', result[1][0])
+        print('\r[%s/%s] %s' % (i, len(pathfiles), result[1][0]), end='', flush=True)
+    record_batch(conn, batch)
+    log.info('all fingerprints recorded in the database')
+    # index fingerprints (ver.2) for identification
+    index.build(conn)
+    if pathfiles:
+        print()
+
+
+def record_batch(conn, batch):
+    """ record songs and their fingerprints in one transaction
+
+    a crash leaves no song without its fingerprints
+
+    Params
+    + batch (list) - (metadata, fingerprints, file) of each song, see
+      ingest_file()
+    """
+    with d.transaction(conn):
+        for tup, _, file in batch:
+            d.add_song(tup, conn, file)
+        # add fingerprints to database, update fingerprinted status
+        d.add_fingerprints([fingerprints for _, fingerprints, _ in batch], conn)
+
+
+def ingest(pathfiles, jobs=1, keep_wav=False, settings=None):
+    """ decode and fingerprint mp3 files in worker processes
+
+    Return
+    + iterator of (metadata, fingerprints, file) in order of
+      completion, see ingest_file()
+    """
+    work = functools.partial(ingest_file, keep_wav=keep_wav, settings=settings)
+    if jobs == 1 or len(pathfiles) <= 1:
+        yield from map(work, pathfiles)
+        return
+    with multiprocessing.Pool(min(jobs, len(pathfiles))) as pool:
+        for result, worker in pool.imap_unordered(metrics.Collect(work), pathfiles):
+            metrics.merge(worker)
+            yield result
+
+
+@metrics.timed("fun.ingest_file")
+def ingest_file(pathfile, keep_wav=False, settings=None):
+    """ read metadata, decode and compute fingerprints of a mp3
+
+    the samples are analyzed as ffmpeg decodes them (see
+    convert.decode), a wav copy is kept in ./music/wav only if
+    keep_wav. decoded samples and fingerprints are reused from the
+    cache if there is one, see cache.py
+
+    Return
+    + metadata (tuple) - (title, artist, album)
+    + fingerprints (tuple) - (filename, t, fingerprints1, fingerprints2,
+      hashes, anchors), as expected by database.add_fingerprints()
+    + file (tuple) - (address, size, mtime, digest), see convert.stat
+    """
+    # read metadata
+    tup = c.meta(pathfile)
+    file = c.stat(pathfile)
+    filename = os.path.basename(pathfile)[:-3] + "wav"
+    settings = settings or a.SETTINGS
+    # fingerprints of the same content with the same settings
+    features = cache.key("features", file[3], settings)
+    arrays = None if keep_wav else cache.get(features, FEATURES)
+    if arrays is None:
+        arrays = fingerprint_file(pathfile, file[3], keep_wav, settings)
+        cache.put(features, FEATURES, arrays)
+
+    return tup, (filename,) + tuple(arrays), file
+
+
+def fingerprint_file(pathfile, digest, keep_wav=False, settings=None):
+    """ compute all fingerprints of a mp3, decoded as a stream, or of
+    its samples in the cache
+
+    the samples are kept in memory only to save them in the cache, if
+    there is one (one channel at the analysis rate)
+    """
+    settings = settings or a.SETTINGS
+    rate = decode_rate(settings)
+    pcm = cache.key("pcm", digest, {"rate": rate})
+    arrays = None if keep_wav else cache.get(pcm, ("framerate", "series"))
+    if arrays is not None:
+        return compute_fingerprints(int(arrays[0]), arrays[1], settings)
+    framerate, blocks = c.decode(pathfile, rate, keep_wav)
+    kept = []
+    if cache.CACHE is not None:
+        blocks = (kept.append(block) or block for block in blocks)
+    arrays = stream_fingerprints(framerate, blocks, settings)
+    if kept:
+        cache.put(pcm, ("framerate", "series"), (framerate, np.concatenate(kept)))
+
+    return arrays
+
+
+def decode_rate(settings):
+    """ samples per second to decode mp3 to: the rate of the analysis,
+    None (the rate of the mp3) if it differs between fingerprints """
+    rates = {settings[name]["rate"] for name in ("fingerprint", "hash")}
+    return rates.pop() if len(rates) == 1 else None
+
+
+def add_single(conn, pathfile, keep_wav=False):
     """ add a single song to database """
     if pathfile.endswith(".mp3"):
-            # read metadata
-            tup = c.meta(pathfile)
-            d.add_song(tup, conn)
-            log.info('metadata recorded in the database')
-            # convert mp3 to wav
-            c.convert(pathfile)
-            log.info('audio converted to wav')
-            # read the wav from local directory
+            settings = load_settings(conn)
+            record_batch(conn, [ingest_file(pathfile, keep_wav, settings)])
+            log.info('metadata and fingerprints recorded in the database')
+            index.build(conn)
             filename = os.path.basename(pathfile)
-            pathwav = "./music/wav/" + filename[:-3] + "wav"
-             # compute spectrogram and fingerprints
-            framerate, f, t, spect = a.spectrogram(pathwav)
-            fingerprints1 = a.fingerprint(f, spect)
-            fingerprints2 = a.fingerprint2(f, spect, framerate)
-            song_id = d.select_songid(filename, conn)
-            log.info('audio file no. %s recorded in the database', song_id)
-            # add fingerprints to database
-            d.add_fingerprint(filename, t, fingerprints1, fingerprints2, conn)
-            # update fingerprinted status
-            d.update_fingerprinted(song_id, conn)
+            log.info('audio file %s recorded in the database', filename)
 
             print('Done!', filename, 'added to your database ❤')
 
 
-def identify1(conn, pathfile):
-    """ identify a snippet (wav) with fingerprint ver.1 """
+@metrics.timed("fun.compute_fingerprints")
+def compute_fingerprints(framerate, series, settings=None):
+    """ compute all fingerprints of audio samples
+
+    the spectrogram is streamed block by block, so memory does not
+    grow with the length of the recording (series can be memory-mapped,
+    see analyze.read)
+
+    Return
+    + (t, fingerprints1, fingerprints2, hashes, anchors)
+    """
+    settings = settings or a.SETTINGS
+    blocks = list(a.stream_fingerprints(framerate, series, settings["fingerprint"]))
+    t, fingerprints1, fingerprints2 = (
+        np.concatenate([block[i] for block in blocks]) for i in range(3))
+    blocks = list(a.stream_hashes(framerate, series, settings["hash"]))
+    hashes, anchors = (
+        np.concatenate([block[i] for block in blocks]) for i in range(2))
 
-    # read snippet and compute fingerprints
-    _, f, _, spect = a.spectrogram(pathfile)
-    f_snippet = a.fingerprint(f, spect)
-    # create a list to store number of matches for each song
-    match_count = []
-
-    # iterate through all songs in database
-    log.info("iterating through all songs in database")
-    max_song_id = d.select_max_song_id(conn)
-    for i in range(1, max_song_id+1):
-        count = 0
-        # get all fingerprints (ver.1) of the song
-        records = d.select_fingerprint1(conn, i)
-        # iterate through the fingerprints
-        for f1 in records:
-            for f2 in f_snippet:
-                if a.match(f1, f2):
-                    count += 1
-        # record number of matches for each song
-        match_count.append(count)
-
-    # find the best match
-    max_count = max(match_count)
+    return t, fingerprints1, fingerprints2, hashes, anchors
+
+
+@metrics.timed("fun.stream_fingerprints")
+def stream_fingerprints(framerate, blocks, settings=None):
+    """ compute all fingerprints of samples arriving block by block
+
+    same as compute_fingerprints(), in a single pass over the samples
+    (like the output of convert.decode): only the samples of the
+    windows being computed are in memory, see analyze.Rolling
+
+    Return
+    + (t, fingerprints1, fingerprints2, hashes, anchors)
+    """
+    settings = settings or a.SETTINGS
+    rollings = a.Rolling(framerate, settings["fingerprint"]), a.Rolling(framerate, settings["hash"])
+    bands = settings["fingerprint"].get("bands", "octave")
+    hashes = a.Hashes()
+    windows = []
+    pairs = []
+    # None: the stream has ended, its last windows
+    for samples in itertools.chain(blocks, [None]):
+        new = [rolling.finish() if samples is None else rolling.add(samples) for rolling in rollings]
+        if new[0] is not None:
+            f, t, spect = new[0]
+            windows.append((t, a.fingerprint(f, spect), a.fingerprint2(f, spect, rollings[0].rate, bands)))
+        if new[1] is not None:
+            pairs.append(hashes.add(new[1][2]))
+    last = hashes.finish()
+    if last is not None:
+        pairs.append(last)
+    t, fingerprints1, fingerprints2 = (
+        np.concatenate([block[i] for block in windows]) for i in range(3))
+    hashes, anchors = (
+        np.concatenate([block[i] for block in pairs]) for i in range(2))
+
+    return t, fingerprints1, fingerprints2, hashes, anchors
+
+
+def load_settings(conn):
+    """ analysis settings of the database, see analyze.SETTINGS
+
+    + databases built before settings were recorded: LEGACY_SETTINGS
+    + new empty databases: SETTINGS, recorded from now on
+    """
+    settings = d.select_settings(conn)
+    if settings is None:
+        return a.LEGACY_SETTINGS
+    if not settings:
+        d.add_settings(a.SETTINGS, conn)
+        return a.SETTINGS
+    return settings
+
+
+def best_titles(conn, type, song_ids, scores, threshold=None):
+    """ titles of all best match(es), see rank()
+
+    no title if the best score is under threshold (MIN_SCORE of type)
+    """
+    threshold = MIN_SCORE[type] if threshold is None else threshold
+    if len(song_ids) == 0 or scores.max() < threshold:
+        log.info("no match found")
+        return []
     log.info("best match found")
     # find all song_ids of the best match(es)
-    l_songid = [i+1 for i, j in enumerate(match_count) if j == max_count]
-    # get the song titles
-    titlelist = []
-    for song_id in l_songid:
-        title = d.select_title(song_id, conn)
-        titlelist.append(title)
-        log.info('song title found for best match with song_id=%s', song_id)
+    l_songid = song_ids[scores == scores.max()]
+    # get the song titles at once
+    titles = d.select_titles(l_songid, conn)
+
+    return [titles[int(song_id)] for song_id in l_songid]
+
+
+@metrics.timed("fun.top_matches")
+def top_matches(conn, type, song_ids, scores, offsets, k=TOP, threshold=None):
+    """ the k best matches of a snippet, see rank()
+
+    Return
+    + list of dict (song_id, title, score, offset), best first, only
+      matches scoring at least threshold (MIN_SCORE of type)
+    """
+    threshold = MIN_SCORE[type] if threshold is None else threshold
+    keep = scores[:k] >= threshold
+    song_ids, scores, offsets = song_ids[:k][keep], scores[:k][keep], offsets[:k][keep]
+    titles = d.select_titles(song_ids, conn)
+
+    return [{"song_id": int(song_id), "title": titles[int(song_id)],
+             "score": float(score), "offset": float(offset)}
+            for song_id, score, offset in zip(song_ids, scores, offsets)]
+
 
-    return titlelist
+@metrics.timed("fun.snippet_fingerprints")
+def snippet_fingerprints(pathfile, type, settings):
+    """ read a snippet (wav) and compute its fingerprints
+
+    Return
+    + type 1, 2 - (fingerprints, centers) of the snippet windows,
+      fingerprints ver.1 or ver.2
+    + type 3 - (hashes, anchors), see analyze.fingerprint3()
+    """
+    if type == 3:
+        _, _, _, spect = a.spectrogram(pathfile, settings["hash"])
+        return a.fingerprint3(spect)
+    framerate, f, t, spect = a.spectrogram(pathfile, settings["fingerprint"])
+    if type == 1:
+        return a.fingerprint(f, spect), t
+    return a.fingerprint2(f, spect, framerate, settings["fingerprint"].get("bands", "octave")), t
+
+
+@metrics.timed("fun.rank")
+def rank(conn, type, fingerprints, settings):
+    """ score songs against the fingerprints of a snippet
+
+    + type 1, 2 - snippet windows matching windows of a song vote for
+      their time offset (see analyze.align), stops early once a song
+      clearly wins
+    + type 3 - hashes of the snippet found in the hash index vote for
+      their time offset (see analyze.vote), only songs sharing hashes
+      with the snippet are touched
+
+    songs matching a sample of the snippet windows the most are
+    aligned (analyze.candidates), the others are left out
+
+    Return
+    + (array, array, array) - song_ids, scores (share of the snippet
+      windows or hashes voting for the best offset, 0 to 1) and
+      offsets (seconds into the song), best match first
+    + float - confidence of the best match, see analyze.confidence()
+    """
+    if type == 3:
+        hashes, anchors = fingerprints
+        # look up all hashes of the snippet at once
+        log.info("looking up snippet hashes in database")
+        records = d.select_hash(conn, hashes)
+        song_ids, scores, offsets = a.vote(hashes, anchors, records)
+        offsets = offsets * settings["hash"]["hop"]
+        n = len(hashes)
+    else:
+        f_snippet, t_snippet = fingerprints
+        # compare the snippet with all songs in database at once
+        cat = catalog.load(conn, type)
+        if type == 1:
+            # same precision as the catalog, for exact matches
+            f_snippet = f_snippet.astype(cat.records.dtype)
+        search = None
+        # the rows of the index are the rows of the whole catalog
+        tree = index.load(conn) if type == 2 else None
+        if tree is not None:
+            # only visit stored windows near the snippet
+            search = functools.partial(index.query, tree)
+        # pre-filter the songs to align
+        songs = cat.songs
+        if len(songs) > a.CANDIDATES:
+            songs = a.candidates(cat.song_ids, f_snippet, cat.records, a.CANDIDATES, search=search)
+        log.info("%s candidate songs", len(songs))
+        rows = catalog.rows(cat, songs)
+        if search is None:
+            records, song_ids, centers = cat.records[rows], cat.song_ids[rows], cat.centers[rows]
+        else:
+            keep = np.zeros(len(cat.records), dtype=bool)
+            keep[rows] = True
+            search = functools.partial(index.query, tree, keep=keep)
+            records, song_ids, centers = cat.records, cat.song_ids, cat.centers
+        (song_ids, scores, offsets), n = a.align(
+            records, song_ids, centers, f_snippet, t_snippet,
+            settings["fingerprint"]["hop"], search=search)
+    order = np.argsort(-scores, kind="stable")
+    confidence = a.confidence(scores, n)
+    # share of the snippet voting for each song
+    scores = scores / max(n, 1)
+
+    return song_ids[order], scores[order], offsets[order], confidence
+
+
+@metrics.timed("fun.identify")
+def identify(conn, pathfile, type=2, k=TOP, threshold=None):
+    """ identify a snippet (wav) with fingerprint ver.1, 2 or 3
+
+    Return
+    + list - the k best matches, see top_matches(), empty if no song
+      scores at least threshold (MIN_SCORE of type)
+    + float - confidence, from 0 (no song stands out) to 1
+    """
+    settings = load_settings(conn)
+    fingerprints = snippet_fingerprints(pathfile, type, settings)
+    song_ids, scores, offsets, confidence = rank(conn, type, fingerprints, settings)
+
+    return top_matches(conn, type, song_ids, scores, offsets, k, threshold), confidence
+
+
+def identify1(conn, pathfile):
+    """ identify a snippet (wav) with fingerprint ver.1 """
+    settings = load_settings(conn)
+    fingerprints = snippet_fingerprints(pathfile, 1, settings)
+    song_ids, scores, _, _ = rank(conn, 1, fingerprints, settings)
+
+    return best_titles(conn, 1, song_ids, scores)
 
 
 def identify2(conn, pathfile):
     """ identify a snippet (wav) with fingerprint ver.2 """
+    settings = load_settings(conn)
+    fingerprints = snippet_fingerprints(pathfile, 2, settings)
+    song_ids, scores, _, _ = rank(conn, 2, fingerprints, settings)
+
+    return best_titles(conn, 2, song_ids, scores)
+
+
+def identify3(conn, pathfile):
+    """ identify a snippet (wav) with fingerprint ver.3
+
+    look up the peak-pair hashes of the snippet in the hash index,
+    then vote on time offsets. only songs sharing hashes with the
+    snippet are touched, so the cost does not grow with the library
+    """
+    settings = load_settings(conn)
+    fingerprints = snippet_fingerprints(pathfile, 3, settings)
+    song_ids, scores, _, _ = rank(conn, 3, fingerprints, settings)
+
+    return best_titles(conn, 3, song_ids, scores)
+
+
+def identify_batch(conn, pathfiles, type=2, top=TOP, jobs=None, threshold=None):
+    """ identify many snippets (wav) at once
+
+    HOW IT WORKS
+    + the settings and the fingerprint catalog are loaded once
+    + jobs (int) worker processes read and fingerprint the snippets,
+      one per cpu by default
+    + this process scores them against the shared catalog (and its
+      index) as they come, in the order of pathfiles
+
+    Return
+    + iterator of dict, one per snippet: path, top matches (song_id,
+      title, score, offset), confidence of the best match and seconds
+      spent per stage, or error
+    """
+    settings = load_settings(conn)
+    if type != 3:
+        catalog.load(conn, type)
+    if type == 2:
+        index.load(conn)
+    jobs = jobs or os.cpu_count() or 1
+    log.info("identifying %s snippets with %s worker(s)", len(pathfiles), jobs)
+
+    results = analyze_snippets(pathfiles, type, settings, jobs)
+    for pathfile, fingerprints, seconds in results:
+        result = {"path": pathfile}
+        if isinstance(fingerprints, str):
+            result["error"] = fingerprints
+            yield result
+            continue
+        start = time.perf_counter()
+        song_ids, scores, offsets, confidence = rank(conn, type, fingerprints, settings)
+        seconds["match"] = time.perf_counter() - start
+        start = time.perf_counter()
+        result["matches"] = top_matches(conn, type, song_ids, scores, offsets, top, threshold)
+        result["confidence"] = confidence
+        seconds["lookup"] = time.perf_counter() - start
+        result["seconds"] = seconds
+        yield result
+
+
+def analyze_snippets(pathfiles, type, settings, jobs=1):
+    """ fingerprint snippets in worker processes, see analyze_snippet()
+
+    Return
+    + iterator of results, in the order of pathfiles
+    """
+    work = functools.partial(analyze_snippet, type=type, settings=settings)
+    if jobs == 1 or len(pathfiles) <= 1:
+        yield from map(work, pathfiles)
+        return
+    with multiprocessing.Pool(min(jobs, len(pathfiles))) as pool:
+        for result, worker in pool.imap(metrics.Collect(work), pathfiles, chunksize=4):
+            metrics.merge(worker)
+            yield result
 
-    # read snippet and compute fingerprints
-    framerate, f, _, spect = a.spectrogram(pathfile)
-    f_snippet = a.fingerprint2(f, spect, framerate)
-    # create a list to store number of matches for each song
-    match_count = []
-
-    # iterate through all songs in database
-    log.info("iterating through all songs in database")
-    max_song_id = d.select_max_song_id(conn)
-    for i in range(1, max_song_id+1):
-        count = 0
-        # get all fingerprints (ver.2) of the song
-        records = d.select_fingerprint2(conn, i)
-        # iterate through the fingerprints
-        for f1 in records:
-            # look at the first window (0-10s) of f2 only
-            f2 = f_snippet[0]
-            if a.match2(f1, f2):
-                count += 1
-        # record number of matches for each song
-        match_count.append(count)
-
-    # find the best match
-    max_count = max(match_count)
-    log.info("best match found")
-    # find all song_ids of the best match(es)
-    l_songid = [i+1 for i, j in enumerate(match_count) if j == max_count]
-    # get the song titles
-    titlelist = []
-    for song_id in l_songid:
-        title = d.select_title(song_id, conn)
-        titlelist.append(title)
-        log.info('song title found for best match with song_id=%s', song_id)
 
-    return titlelist
+def analyze_snippet(pathfile, type, settings):
+    """ fingerprints of a snippet in a worker
+
+    Return
+    + (pathfile, fingerprints or error message, {"analyze": seconds})
+    """
+    start = time.perf_counter()
+    if not pathfile.endswith(".wav"):
+        return pathfile, "audio file must be in wav format", {}
+    try:
+        fingerprints = snippet_fingerprints(pathfile, type, settings)
+    except (OSError, ValueError) as error:
+        return pathfile, str(error), {}
+
+    return pathfile, fingerprints, {"analyze": time.perf_counter() - start}
+
+
+def write_results(results, file, format="jsonl"):
+    """ write results of identify_batch() as json lines or csv
+
+    csv has one row per match: path, rank, song_id, title, score,
+    offset, confidence, seconds per stage and error
+    """
+    if format == "jsonl":
+        for result in results:
+            file.write(json.dumps(result) + "\n")
+        return
+    writer = csv.writer(file)
+    writer.writerow(["path", "rank", "song_id", "title", "score", "offset",
+                     "confidence", "analyze", "match", "lookup", "error"])
+    for result in results:
+        seconds = result.get("seconds", {})
+        stages = [seconds.get(stage) for stage in ("analyze", "match", "lookup")]
+        matches = result.get("matches") or [{}]
+        for i, match in enumerate(matches, 1):
+            writer.writerow(
+                [result["path"], i if match else None]
+                + [match.get(key) for key in ("song_id", "title", "score", "offset")]
+                + [result.get("confidence")] + stages + [result.get("error")])
 
 
 # TEST OUTPUT
@@ -205,7 +663,7 @@ def interact():
     opt = int(input('Please select an option above: '))
 
     if opt == 1:
-        firststep(conn)
+        firststep(d.conn)
     elif opt == 2:
         print('Oops, the feature is in progress. See you in the next release!')
     else:
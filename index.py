@@ -0,0 +1,133 @@
+# RUN THIS PROGRAM TO:
+# find the stored windows matching a snippet (ver.2) without
+# comparing it to every window of the catalog
+
+# HOW IT WORKS
+# + a k-d tree (scipy cKDTree) over the fingerprints (ver.2) of the
+#   catalog, see catalog.py
+# + match2() is a chebyshev distance under 0.1, that is a ball query
+#   of radius 0.1 with p=inf: only the branches of the tree near the
+#   snippet are visited
+# + EPS trades recall for speed: with eps > 0 a branch is skipped
+#   when its windows are further than r/(1+eps), so some matches
+#   between r/(1+eps) and r may be missed. 0 (default) finds exactly
+#   the matches of match2()
+# + built at ingest, saved next to the sqlite database (or to
+#   FREEZAM_INDEX) with the stamp of its catalog, and rebuilt when
+#   the stamp changes: on every write, and when the database is
+#   rebuilt, even with the same songs (see database.select_stamp)
+
+
+import os
+import pickle
+import logging
+import numpy as np
+from scipy.spatial import cKDTree
+import catalog
+import database as d
+import metrics
+
+
+log = logging.getLogger(__name__)
+
+# tolerance of analyze.match2()
+RADIUS = 0.1
+# approximation of the ball queries, see above
+EPS = float(os.environ.get("FREEZAM_EPS", 0))
+# index file, None for next to the sqlite database
+PATH = os.environ.get("FREEZAM_INDEX")
+
+# (database.generation, stamp, cKDTree)
+_cache = None
+
+
+def load(conn):
+    """ k-d tree over the fingerprints (ver.2) of all songs, see build()
+
+    rows of the tree are rows of catalog.load(conn, 2)
+    """
+    global _cache
+    stamp = d.select_stamp(conn)
+    if _cache is not None and _cache[0] == d.generation and _cache[1] == stamp:
+        return _cache[2]
+
+    tree = read(stamp)
+    if tree is None:
+        tree = build(conn)
+    _cache = (d.generation, stamp, tree)
+
+    return tree
+
+
+@metrics.timed("index.build")
+def build(conn):
+    """ build the tree of the current catalog, and save it
+
+    Return
+    + cKDTree, None if no song is fingerprinted
+    """
+    cat = catalog.load(conn, 2)
+    if len(cat.records) == 0:
+        return None
+    records = np.asarray(cat.records, dtype=float)
+    tree = cKDTree(records)
+    log.info("index of %s fingerprints (ver.2) built", len(records))
+    path = index_path(cat.stamp)
+    if path is not None:
+        with open(path, "wb") as file:
+            pickle.dump((cat.stamp, tree), file)
+        log.info("index saved to %s", path)
+
+    return tree
+
+
+def read(stamp):
+    """ the saved tree, None if missing or out of date """
+    path = index_path(stamp)
+    try:
+        with open(path, "rb") as file:
+            saved, tree = pickle.load(file)
+    except (TypeError, OSError, pickle.UnpicklingError, EOFError, ValueError):
+        return None
+    if tuple(saved) != stamp:
+        return None
+    log.info("index read from %s", path)
+
+    return tree
+
+
+def index_path(stamp):
+    """ index file of a database, None to keep it in memory only """
+    if PATH is not None:
+        return PATH
+    if os.path.isfile(stamp[0]):
+        return stamp[0] + ".kdtree"
+    return None
+
+
+def query(tree, f_snippet, eps=EPS, keep=None):
+    """ stored windows within RADIUS of each window of a snippet
+
+    Params
+    + keep (array) - boolean for each row of the tree, only return
+      rows where True (None for all rows)
+
+    Return
+    + (array, array) - rows of the tree and windows of the snippet
+      of each candidate pair, to be checked with match2()
+    """
+    neighbours = tree.query_ball_point(
+        np.asarray(f_snippet, dtype=float), r=RADIUS, p=np.inf, eps=eps)
+    lengths = [len(rows) for rows in neighbours]
+    rows = np.concatenate(neighbours).astype(np.int64) if sum(lengths) else np.zeros(0, dtype=np.int64)
+    cols = np.repeat(np.arange(len(neighbours)), lengths)
+    if keep is not None:
+        rows, cols = rows[keep[rows]], cols[keep[rows]]
+
+    return rows, cols
+
+
+def invalidate():
+    """ forget the tree loaded by this process """
+    global _cache
+    _cache = None
@@ -1,10 +1,13 @@
+import os
 import sys
+import json
 import logging
 import argparse
-import fun as f
-import convert as c
-import database as d
-from database import conn
+import metrics
+
+# the other modules are imported by the commands using them: analyze
+# and fun load scipy, convert loads pydub, so light commands like
+# list or remove start fast
 
 
 # INTERFACE DESIGN
@@ -13,12 +16,16 @@ parser = argparse.ArgumentParser(
     description='Freezam: process and identify audio files')
 parser.add_argument('-v', '--version', action='version', version='Freezam 0.5 beta')
 parser.add_argument("-vb", "--verbose", action="store_true", help="switch btw log levels")
+parser.add_argument("--profile", nargs="?", const="-", metavar="FILE",
+                    help="print time, counters and peak memory of each stage when done, "
+                    "and save them to FILE (json, or prometheus text for .prom)")
 
 # subcommands
 subparsers = parser.add_subparsers(dest='subcommands')
 # add
 parser_add = subparsers.add_parser("add", help='add a song to database')
 parser_add.add_argument('--pathfile', type=str, help='pathfile of the song')
+parser_add.add_argument('--keep-wav', action='store_true', help='also keep a wav copy in ./music/wav')
 # update (modify song info)
 parser_update = subparsers.add_parser("update", help='update metadata of a song')
 parser_update.add_argument('--title', type=str, help='song title')
@@ -29,15 +36,41 @@ parser_remove = subparsers.add_parser("remove", help='remove a song from databas
 parser_remove.add_argument('--title', type=str, help='song title')
 # construct (ingest an entire directory for database construction)
 parser_fun = subparsers.add_parser("construct", help='construct database at 1-click')
+parser_fun.add_argument('--jobs', type=int, help='number of worker processes, default one per cpu')
+parser_fun.add_argument('--keep-wav', action='store_true', help='also keep wav copies in ./music/wav')
+parser_fun.add_argument('--settings', type=str, help='json file of analysis settings, see analyze.SETTINGS')
+parser_fun.add_argument('--update', action='store_true', help='only ingest new and changed files, remove deleted ones')
 # identify
 parser_identify = subparsers.add_parser("identify", help='identify a snippet')
 parser_identify.add_argument('--pathfile', type=str, help='pathfile of the snippet')
-parser_identify.add_argument('--type', type=int, help='1 or 2, fingerprint method for identification')
+parser_identify.add_argument('--type', type=int, help='1, 2 or 3, fingerprint method for identification')
+parser_identify.add_argument('--dir', type=str, help='identify all wav snippets of a directory')
+parser_identify.add_argument('--manifest', type=str, help='identify the snippets listed in a file, one pathfile per line')
+parser_identify.add_argument('--top', type=int, help='number of matches per snippet, default 1 (5 with --dir/--manifest)')
+parser_identify.add_argument('--format', choices=['jsonl', 'csv'], default='jsonl', help='output format (--dir/--manifest)')
+parser_identify.add_argument('--output', type=str, help='output file (--dir/--manifest), default standard output')
+parser_identify.add_argument('--jobs', type=int, help='number of worker processes, default one per cpu')
 # admin
 parser_admin = subparsers.add_parser("admin", help='administrator mode. clean up database,etc.')
-parser_admin.add_argument('--action', type=str, help='rm_dup - remove duplicates in database')
+parser_admin.add_argument('--action', type=str, help='rm_dup - remove duplicates in database, '
+                          'migrate - pack fingerprints of an old database one row per song')
 # list
 parser_list = subparsers.add_parser("list", help='list all songs in database')
+# listen
+parser_listen = subparsers.add_parser("listen", help='identify a stream of samples as it arrives')
+parser_listen.add_argument('--pathfile', type=str, default='-', help='fifo or file being written, default standard input')
+parser_listen.add_argument('--rate', type=int, default=8000, help='samples per second of raw pcm, default 8000')
+parser_listen.add_argument('--channels', type=int, default=1, help='channels of raw pcm, default 1')
+parser_listen.add_argument('--type', type=int, default=2, help='1, 2 or 3, fingerprint method for identification')
+parser_listen.add_argument('--threshold', type=float, default=0.5, help='confidence to report a match, default 0.5')
+# plot
+parser_plot = subparsers.add_parser("plot", help='plot the spectrogram of a wav file')
+parser_plot.add_argument('--pathfile', type=str, help='pathfile of the wav file')
+parser_plot.add_argument('--output', type=str, help='save the plot to this file (like "plot.png") instead of showing it')
+# serve
+parser_serve = subparsers.add_parser("serve", help='identify snippets for local clients, with a warm index')
+parser_serve.add_argument('--port', type=int, default=8765, help='localhost http port, default 8765')
+parser_serve.add_argument('--socket', type=str, help='listen on this unix socket instead of http')
 
 args = parser.parse_args()
 
@@ -69,11 +102,26 @@ log = logging.getLogger(__name__)
 
 def main():
     """ execute the commands given in interface """
+    # plot (no database needed)
+    if args.subcommands == "plot":
+        import analyze as a
+        if args.pathfile is None:
+            log.error('expected a pathfile for "plot" command')
+            return
+        spectrogram = a.spectrogram(args.pathfile)
+        if spectrogram is not None:
+            _, freqs, t, spect = spectrogram
+            a.plot_spectrogram(freqs, t, spect, args.output)
+        return
+
+    import database as d
+    conn = d.connect()
 
     # add
     if args.subcommands == "add":
+        import fun as f
         pathfile = args.pathfile
-        f.add_single(conn, pathfile)
+        f.add_single(conn, pathfile, args.keep_wav)
 
     # update
     if args.subcommands == "update":
@@ -91,34 +139,63 @@ def main():
     # remove
     if args.subcommands == "remove":
         title = args.title
-        d.drop_song(conn, title)
+        d.drop_song(title, conn)
         log.info('song %s removed from database', title)
 
     # construct
     if args.subcommands == "construct":
-        f.firststep(conn)
+        import fun as f
+        settings = None
+        if args.settings is not None:
+            with open(args.settings) as file:
+                settings = json.load(file)
+        if args.update:
+            if settings is not None:
+                log.warning('--settings ignored with --update, the database keeps its settings')
+            f.sync(conn, args.jobs, args.keep_wav)
+        else:
+            f.firststep(conn, args.jobs, args.keep_wav, settings)
 
     # identify
     if args.subcommands == 'identify':
+        import fun as f
         pathfile = args.pathfile
         type = args.type
-        if pathfile is None:
-            log.error('expected a pathfile for "identify" command')
+        if args.dir is not None or args.manifest is not None:
+            # batch mode
+            if args.dir is not None:
+                pathfiles = [os.path.join(args.dir, file) for file in sorted(os.listdir(args.dir))
+                             if file.endswith(".wav")]
+            else:
+                with open(args.manifest) as file:
+                    pathfiles = [line.strip() for line in file
+                                 if line.strip() and not line.startswith("#")]
+            results = f.identify_batch(conn, pathfiles, type or 2, args.top or f.TOP, args.jobs)
+            if args.output is None:
+                f.write_results(results, sys.stdout, args.format)
+            else:
+                with open(args.output, "w", newline="") as file:
+                    f.write_results(results, file, args.format)
+        elif pathfile is None:
+            log.error('expected a pathfile, a dir or a manifest for "identify" command')
         else:
-            if type == 1:
-                # match by local peak
-                titlelist = f.identify1(conn, pathfile)
-                for title in titlelist:
-                    print('The best match is:', title)
-
-            elif type == 2 or type is None:
-                # match by maximum power per octave (default)
-                titlelist = f.identify2(conn, pathfile)
-                for title in titlelist:
-                    print('The best match is:', title)
-
+            # 1: match by local peak
+            # 2: match by maximum power per octave (default)
+            # 3: match by peak-pair hashes
+            type = type or 2
+            if type in (1, 2, 3):
+                matches, confidence = f.identify(conn, pathfile, type, args.top or 1)
+                if not matches:
+                    print('No match found')
+                for i, match in enumerate(matches):
+                    if i == 0:
+                        print('The best match is:', match["title"])
+                        print('at %.1f s, confidence %.2f' % (match["offset"], confidence))
+                    else:
+                        print('%s. %s (score %.2f, at %.1f s)' % (
+                            i+1, match["title"], match["score"], match["offset"]))
             else:
-                log.error('expected 1 or 2 for "type"')
+                log.error('expected 1, 2 or 3 for "type"')
 
 
     # admin
@@ -128,6 +205,12 @@ def main():
             # remove duplicates
             d.drop_duplicate(conn)
             log.info('all duplicates removed from database')
+        elif action == "migrate":
+            # pack fingerprints one row per song
+            if d.migrate(conn):
+                log.info('fingerprints packed one row per song')
+            else:
+                log.info('fingerprints already packed, nothing to migrate')
         else:
             log.error('action not recognized, please checkout "python interface.py admin -h" for available choices')
 
@@ -136,11 +219,38 @@ def main():
         titles = d.list_all_songs(conn)
         for title in titles:
             print(title)
-        
+
+    # listen
+    if args.subcommands == 'listen':
+        import listen
+        stream, follow = listen.open_stream(args.pathfile)
+        with stream:
+            found = listen.identify_stream(conn, stream, args.type, args.rate, args.channels,
+                                           args.threshold, follow)
+        if found is None:
+            print('No match found')
+        else:
+            heard, match, confidence = found
+            print('The best match is:', match["title"])
+            print('now at %.1f s, confidence %.2f, after %.1f s of audio' % (
+                match["offset"] + heard, confidence, heard))
+
+    # serve
+    if args.subcommands == 'serve':
+        import server
+        conn.close()
+        server.serve(args.socket or (server.HOST, args.port))
+
 
 
 # RUN
+if args.profile is not None:
+    metrics.ENABLED = True
 main()
+if args.profile is not None:
+    metrics.report()
+    if args.profile != "-":
+        metrics.dump(args.profile)
 
 
 # TEST INPUT
@@ -0,0 +1,168 @@
+# RUN THIS PROGRAM TO:
+# identify a song while it is playing, from samples arriving on
+# standard input, a fifo, or a file being appended to
+
+# HOW IT WORKS
+# + samples are raw 16-bit little-endian pcm (like "arecord -t raw
+#   -f S16_LE" or "ffmpeg -f s16le"), or a wav stream
+# + they are read STEP seconds at a time, and the spectrogram of
+#   the last BUFFER seconds is kept (rolling buffer): only the
+#   windows completed by the new samples are computed
+# + after each step the buffer is ranked against the catalog, see
+#   fun.rank, and the first match reaching the confidence threshold
+#   is reported right away
+# + a regular file is followed like "tail -f", until no sample
+#   arrives for IDLE seconds
+
+
+import os
+import stat
+import time
+import struct
+import logging
+import numpy as np
+import analyze as a
+import catalog
+import index
+import fun as f
+
+
+log = logging.getLogger(__name__)
+
+# seconds of audio read at a time
+STEP = 0.5
+# seconds of audio kept to identify
+BUFFER = 15
+# lowest confidence of a match to report, see analyze.confidence()
+THRESHOLD = 0.5
+# seconds heard before reporting a match
+MIN_HEARD = 2
+# seconds to wait for a file to grow, and between two tries
+IDLE = 5
+POLL = 0.1
+
+
+def fingerprints(rolling, type, bands="octave"):
+    """ fingerprints of the buffer, as expected by fun.rank()
+
+    times and anchors count from the beginning of the stream
+    """
+    if type == 3:
+        hashes, anchors = a.fingerprint3(rolling.spect)
+        return hashes, anchors + rolling.first
+    if type == 1:
+        return a.fingerprint(rolling.f, rolling.spect), rolling.t
+    return a.fingerprint2(rolling.f, rolling.spect, rolling.rate, bands), rolling.t
+
+
+def listen(conn, stream, type=2, framerate=8000, channels=1, step=STEP, seconds=BUFFER, follow=False):
+    """ rank a stream against the catalog as it arrives
+
+    framerate and channels of raw pcm, a wav stream has its own
+
+    Yield
+    + (heard, matches, confidence) after each step: seconds received,
+      best match (see fun.identify) and its confidence. the offset of
+      a match is the position in the song at the start of the stream
+    """
+    settings = f.load_settings(conn)
+    # the whole catalog, ranked against at every step
+    if type != 3:
+        catalog.load(conn, type)
+    if type == 2:
+        index.load(conn)
+    framerate, channels, rest = header(stream, framerate, channels)
+    log.info("listening to %s Hz, %s channel(s)", framerate, channels)
+    rolling = a.Rolling(framerate, settings["hash" if type == 3 else "fingerprint"], seconds)
+    for samples in read(stream, channels, int(step * framerate), rest, follow):
+        rolling.add(samples)
+        if rolling.spect is None or rolling.spect.shape[1] == 0:
+            continue
+        features = fingerprints(rolling, type, settings["fingerprint"].get("bands", "octave"))
+        song_ids, scores, offsets, confidence = f.rank(conn, type, features, settings)
+        yield rolling.heard(), f.top_matches(conn, type, song_ids, scores, offsets, 1), confidence
+
+
+def identify_stream(conn, stream, type=2, framerate=8000, channels=1, threshold=THRESHOLD, follow=False):
+    """ the first match of a stream reaching the confidence threshold
+
+    Return
+    + (heard, match, confidence), None if the stream ends first
+    """
+    results = listen(conn, stream, type, framerate, channels, follow=follow)
+    for heard, matches, confidence in results:
+        log.info("%.1f s heard, confidence %.2f", heard, confidence)
+        if matches and heard >= MIN_HEARD and confidence >= threshold:
+            return heard, matches[0], confidence
+    return None
+
+
+def header(stream, framerate=8000, channels=1):
+    """ read the header of a wav stream
+
+    Return
+    + (framerate, channels, bytes) - format of the samples, and the
+      bytes read after the header (raw pcm has no header: the given
+      framerate and channels, and the bytes read)
+    """
+    start = read_exactly(stream, 12)
+    if start[:4] != b"RIFF" or start[8:12] != b"WAVE":
+        return framerate, channels, start
+    while True:
+        chunk = read_exactly(stream, 8)
+        if len(chunk) < 8:
+            raise ValueError("wav stream without data")
+        name, size = chunk[:4], struct.unpack("<I", chunk[4:])[0]
+        if name == b"data":
+            return framerate, channels, b""
+        body = read_exactly(stream, size + size % 2)
+        if name == b"fmt ":
+            codec, channels, framerate = struct.unpack("<HHI", body[:8])
+            bits = struct.unpack("<H", body[14:16])[0]
+            if codec != 1 or bits != 16:
+                raise ValueError("expected 16-bit pcm samples")
+
+
+def read_exactly(stream, size):
+    """ read size bytes, less only at the end of the stream """
+    data = b""
+    while len(data) < size:
+        more = stream.read(size - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+
+def read(stream, channels, block, rest=b"", follow=False):
+    """ read 16-bit samples as they arrive
+
+    Yield
+    + array of shape (n, channels), at most block samples each
+    """
+    size = block * channels * 2
+    frame = channels * 2
+    data = rest
+    idle = 0
+    while True:
+        more = stream.read(size - len(data))
+        data += more
+        if len(data) >= size or (not more and len(data) >= frame):
+            usable = len(data) // frame * frame
+            yield np.frombuffer(data[:usable], dtype="<i2").reshape(-1, channels)
+            data = data[usable:]
+        if more:
+            idle = 0
+            continue
+        if not follow or idle >= IDLE:
+            return
+        time.sleep(POLL)
+        idle += POLL
+
+
+def open_stream(pathfile):
+    """ standard input for "-", else the file, and whether to follow it """
+    if pathfile == "-":
+        return os.fdopen(os.dup(0), "rb", buffering=0), False
+    follow = stat.S_ISREG(os.stat(pathfile).st_mode)
+    return open(pathfile, "rb", buffering=0), follow
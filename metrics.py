@@ -0,0 +1,178 @@
+# RUN THIS PROGRAM TO:
+# measure where time and memory go, while freezam runs
+#
+# python interface.py --profile identify --pathfile=... --type=2
+# python interface.py --profile=metrics.prom construct
+
+# HOW IT WORKS
+# + timers: functions of analyze, convert, database and fun are
+#   wrapped with timed(name), which adds up their calls, wall time
+#   and cpu time (of the calling thread). timers are inclusive:
+#   fun.identify contains fun.rank, which contains analyze.align
+# + counters: count(name, n) adds up sizes, like spectrogram windows,
+#   hashes, bytes decoded, database round-trips and rows
+# + peak memory: the peak resident size of the process and of its
+#   workers, from the operating system
+# + worker processes (ingest, batch identify) send their metrics
+#   back with their results, see Collect
+# + a timer costs a microsecond, so metrics stay on (FREEZAM_METRICS=0
+#   to turn them off), and can be dumped as json or prometheus text
+#   at any time, see dump() and the /metrics request of server.py
+
+
+import os
+import sys
+import json
+import time
+import resource
+import functools
+import threading
+
+
+# FREEZAM_METRICS=0 turns the metrics off
+ENABLED = os.environ.get("FREEZAM_METRICS", "1") != "0"
+
+_lock = threading.Lock()
+# name: [calls, wall seconds, cpu seconds]
+_timers = {}
+# name: total
+_counters = {}
+# peak resident size of finished workers (bytes)
+_peak = 0
+
+
+def timed(name):
+    """ decorator adding the calls and duration of a function to timer name """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return function(*args, **kwargs)
+            wall, cpu = time.perf_counter(), time.thread_time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                add(name, time.perf_counter() - wall, time.thread_time() - cpu)
+        return wrapper
+    return decorate
+
+
+def add(name, wall, cpu, calls=1):
+    """ add calls and seconds to a timer """
+    with _lock:
+        entry = _timers.get(name)
+        if entry is None:
+            _timers[name] = [calls, wall, cpu]
+        else:
+            entry[0] += calls
+            entry[1] += wall
+            entry[2] += cpu
+
+
+def count(name, n=1):
+    """ add n to a counter """
+    if ENABLED:
+        with _lock:
+            _counters[name] = _counters.get(name, 0) + n
+
+
+def peak_memory():
+    """ peak resident size of this process and its workers (bytes) """
+    # kilobytes on linux, bytes on macos
+    scale = 1 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+
+    return max(own, children, _peak)
+
+
+def snapshot():
+    """ all metrics so far
+
+    Return
+    + dict - timers (calls, wall and cpu seconds of each), counters
+      and peak memory (bytes)
+    """
+    with _lock:
+        timers = {name: {"calls": calls, "wall": wall, "cpu": cpu}
+                  for name, (calls, wall, cpu) in sorted(_timers.items())}
+        counters = dict(sorted(_counters.items()))
+
+    return {"timers": timers, "counters": counters, "peak_memory": peak_memory()}
+
+
+def reset():
+    """ forget all metrics """
+    global _peak
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+        _peak = 0
+
+
+def merge(other):
+    """ add the metrics of another process, see snapshot() """
+    global _peak
+    for name, timer in other["timers"].items():
+        add(name, timer["wall"], timer["cpu"], timer["calls"])
+    for name, n in other["counters"].items():
+        count(name, n)
+    _peak = max(_peak, other["peak_memory"])
+
+
+class Collect:
+    """ run a function in a worker process and send its metrics back
+
+    Collect(function)(*args) returns (result, metrics of the call),
+    give the metrics to merge() in the parent process
+    """
+
+    def __init__(self, function):
+        self.function = function
+
+    def __call__(self, *args):
+        reset()
+        result = self.function(*args)
+        return result, snapshot()
+
+
+def prometheus(metrics=None):
+    """ metrics in the prometheus text format """
+    metrics = metrics or snapshot()
+    lines = ["# TYPE freezam_calls_total counter"]
+    lines += ['freezam_calls_total{stage="%s"} %s' % (name, timer["calls"])
+              for name, timer in metrics["timers"].items()]
+    lines.append("# TYPE freezam_seconds_total counter")
+    for name, timer in metrics["timers"].items():
+        lines.append('freezam_seconds_total{stage="%s",clock="wall"} %r' % (name, timer["wall"]))
+        lines.append('freezam_seconds_total{stage="%s",clock="cpu"} %r' % (name, timer["cpu"]))
+    for name, n in metrics["counters"].items():
+        lines.append("# TYPE freezam_%s_total counter" % name)
+        lines.append("freezam_%s_total %s" % (name, n))
+    lines.append("# TYPE freezam_peak_memory_bytes gauge")
+    lines.append("freezam_peak_memory_bytes %s" % metrics["peak_memory"])
+
+    return "\n".join(lines) + "\n"
+
+
+def dump(pathfile, metrics=None):
+    """ write the metrics to a file: prometheus text for .prom and
+    .txt files, json otherwise """
+    metrics = metrics or snapshot()
+    with open(pathfile, "w") as file:
+        if pathfile.endswith((".prom", ".txt")):
+            file.write(prometheus(metrics))
+        else:
+            json.dump(metrics, file, indent=2)
+
+
+def report(file=None, metrics=None):
+    """ print the metrics as a table, slowest stages first """
+    file = file or sys.stderr
+    metrics = metrics or snapshot()
+    print("%-32s %8s %10s %10s" % ("stage", "calls", "wall s", "cpu s"), file=file)
+    for name, timer in sorted(metrics["timers"].items(), key=lambda item: -item[1]["wall"]):
+        print("%-32s %8s %10.3f %10.3f" % (name, timer["calls"], timer["wall"], timer["cpu"]), file=file)
+    for name, n in metrics["counters"].items():
+        print("%-32s %8s" % (name, n), file=file)
+    print("%-32s %8.0f MB" % ("peak memory", metrics["peak_memory"] / 1024**2), file=file)
@@ -0,0 +1,185 @@
+# RUN THIS PROGRAM TO:
+# keep freezam warm and identify snippets for local clients
+
+# HOW IT WORKS
+# + one long-lived process, see "python interface.py serve"
+# + listens on localhost http, or on a unix socket
+# + every client is served in its own thread, with a database
+#   connection taken from a shared pool (database.Pool), so slow
+#   clients do not block the others
+# + the fingerprint catalog (see catalog.py) is loaded once and
+#   shared by all threads, so a query only analyzes the snippet
+#
+# REQUESTS
+# + GET /identify?path=PATHFILE&type=2&top=5 - a wav file on this machine
+# + POST /identify?type=2&top=5 - the wav file sent as request body
+# + GET /songs - all songs in database
+# + GET /metrics - time, counters and peak memory of each stage since
+#   the server started, in the prometheus text format, see metrics.py
+# answers are json, e.g. {"matches": [{"song_id": 3, "title": ...,
+# "score": 0.8, "offset": 12.5}, ...], "confidence": 0.7, "type": 2,
+# "seconds": 0.01}, see fun.identify
+
+
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+import socketserver
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import fun as f
+import catalog
+import index
+import database as d
+import metrics
+
+
+log = logging.getLogger(__name__)
+
+HOST = "127.0.0.1"
+PORT = 8765
+
+
+class Handler(BaseHTTPRequestHandler):
+    """ answer identification requests, see module description """
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        if url.path == "/songs":
+            self.answer(200, {"titles": self.run(d.list_all_songs)})
+        elif url.path == "/metrics":
+            self.answer(200, metrics.prometheus(), "text/plain; version=0.0.4")
+        elif url.path == "/identify":
+            pathfile = query.get("path", [None])[0]
+            if pathfile is None:
+                self.answer(400, {"error": "expected a path"})
+            elif not os.path.isfile(pathfile):
+                self.answer(404, {"error": "no such file: %s" % pathfile})
+            else:
+                self.identify(pathfile, query)
+        else:
+            self.answer(404, {"error": "unknown request: %s" % url.path})
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        if url.path != "/identify":
+            self.answer(404, {"error": "unknown request: %s" % url.path})
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        if length == 0:
+            self.answer(400, {"error": "expected a wav file as request body"})
+            return
+        # analyze.spectrogram reads wav files from disk
+        with tempfile.NamedTemporaryFile(suffix=".wav") as file:
+            file.write(self.rfile.read(length))
+            file.flush()
+            self.identify(file.name, query)
+
+    def identify(self, pathfile, query):
+        """ identify a snippet and answer with matches and timing """
+        type = query.get("type", ["2"])[0]
+        if type not in ("1", "2", "3"):
+            self.answer(400, {"error": 'expected 1, 2 or 3 for "type"'})
+            return
+        try:
+            top = int(query.get("top", [f.TOP])[0])
+        except ValueError:
+            self.answer(400, {"error": 'expected a number for "top"'})
+            return
+        if not pathfile.endswith(".wav"):
+            self.answer(400, {"error": "audio file must be in wav format"})
+            return
+        start = time.perf_counter()
+        try:
+            matches, confidence = self.run(f.identify, pathfile, int(type), top)
+        except ValueError as error:
+            # not a wav file, or too short to be fingerprinted
+            self.answer(400, {"error": str(error)})
+            return
+        seconds = time.perf_counter() - start
+        log.info("snippet %s identified in %.3f s", pathfile, seconds)
+        self.answer(200, {"matches": matches, "confidence": confidence,
+                          "type": int(type), "seconds": seconds})
+
+    def run(self, function, *args):
+        """ call function(conn, *args) with a connection of the pool """
+        with self.server.pool.connection() as conn:
+            return function(conn, *args)
+
+    def answer(self, status, content, type="application/json"):
+        body = (content if isinstance(content, str) else json.dumps(content)).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # unix socket clients have no address
+        return self.client_address[0] if self.client_address else "local"
+
+    def log_message(self, format, *args):
+        log.info("%s %s", self.address_string(), format % args)
+
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ http server on a unix socket, one thread per client """
+    daemon_threads = True
+
+
+def make_server(address=(HOST, PORT), connect=d.connect):
+    """ create a server, without starting it
+
+    Params
+    + address - (host, port) for http, or the path of a unix socket
+    + connect - function returning a new database connection
+    """
+    if isinstance(address, str):
+        if os.path.exists(address):
+            os.remove(address)
+        server = UnixServer(address, Handler)
+    else:
+        server = ThreadingHTTPServer(address, Handler)
+    server.pool = d.Pool(connect)
+    return server
+
+
+def warm(server):
+    """ load the fingerprint catalog before the first client comes """
+    with server.pool.connection() as conn:
+        for version in (1, 2):
+            catalog.load(conn, version)
+        index.load(conn)
+    log.info("fingerprint catalog loaded")
+
+
+def serve(address=(HOST, PORT), connect=d.connect):
+    """ identify snippets until interrupted (ctrl-c) """
+    server = make_server(address, connect)
+    warm(server)
+    if isinstance(address, str):
+        print("Freezam is listening on unix socket %s" % address)
+    else:
+        print("Freezam is listening on http://%s:%s" % server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print()
+    finally:
+        server.server_close()
+        server.pool.close()
+        if isinstance(address, str):
+            os.remove(address)
+        print(' ~See ya~ ')
+
+
+def start(server):
+    """ serve in a background thread, for tests and embedding """
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return thread
@@ -1,27 +1,87 @@
 # pytest -v test_shazam.py
 
 import os
+import shutil
+import tempfile
 import pytest
+import numpy as np
+from scipy.io import wavfile
 import analyze as a
+import bench
+import cache
+import catalog
+import index
+import metrics
 import convert as c
 import fun as f
 
-no_db = False
+import database as d
 
-try:
-    import psycopg2
-except ModuleNotFoundError:
-    no_db = True
-try:
-    import database as d
-except ModuleNotFoundError:
-    no_db = True
-try:
-    from database import conn
-except ModuleNotFoundError:
-    no_db = True
+no_ffmpeg = shutil.which("ffmpeg") is None
 
 
+@pytest.fixture(scope="module")
+def conn(tmp_path_factory):
+    """ an embedded (sqlite) database shared by the tests below """
+    path = tmp_path_factory.mktemp("db") / "freezam.db"
+    conn = d.connect("sqlite", str(path))
+    d.create_table(conn)
+    yield conn
+    conn.close()
+
+
+@pytest.fixture(scope="module")
+def snippet(conn, tmp_path_factory):
+    """ a song in the shared database, and a snippet cut from it """
+    series = np.random.default_rng(3).normal(size=8000*30)
+    d.add_song(("A Tender Feeling", None, None), conn)
+    d.add_fingerprints([("A Tender Feeling.wav",) + f.compute_fingerprints(8000, series)], conn)
+    pathfile = str(tmp_path_factory.mktemp("snippet") / "Track54.wav")
+    wavfile.write(pathfile, 8000, series[8000*10:8000*20])
+    yield pathfile
+    catalog.invalidate()
+    index.invalidate()
+
+
+@pytest.fixture
+def library(tmp_path):
+    """ a synthetic catalog in a temporary database
+
+    library(titles, seconds) records songs of random noise (8 kHz) and
+    their fingerprints, and returns the connection and the samples of
+    each song. the catalog and index of this process are forgotten
+    afterwards
+    """
+    conns = []
+
+    def build(titles, seconds, seed=0, channels=None, scale=1):
+        conn = d.connect("sqlite", str(tmp_path / "freezam.db"))
+        conns.append(conn)
+        d.create_table(conn)
+        rng = np.random.default_rng(seed)
+        shape = (8000*seconds,) if channels is None else (8000*seconds, channels)
+        songs = {}
+        for title in titles:
+            songs[title] = rng.normal(size=shape) * scale
+            d.add_song((title, None, None), conn)
+            d.add_fingerprints([(title + ".wav",) + f.compute_fingerprints(8000, songs[title])], conn)
+        return conn, songs
+
+    yield build
+    catalog.invalidate()
+    index.invalidate()
+    for conn in conns:
+        conn.close()
+
+
+def wav_decode(pathfile, rate=None, keep_wav=False):
+    """ a stand-in for convert.decode: the samples of the wav of the
+    same name in ./music/wav, in one block """
+    framerate, series = wavfile.read(pathfile.replace("mp3", "wav"))
+    return framerate, iter([series])
+
+
+@pytest.mark.skipif(no_ffmpeg, reason="requires ffmpeg to decode mp3")
 def test_convert():
     """test if convert() generates the desired wav from mp3"""
     filename = os.listdir("./music/mp3")[0]
@@ -38,7 +98,6 @@ def test_convert():
     assert find, "convert wav works"
 
 
-@pytest.mark.skipif(no_db, reason="requires postgresql")
 def test_drop_song(conn):
     """test if drop_song works as expected"""
     filename = os.listdir("./music/mp3")[0]
@@ -51,7 +110,6 @@ def test_drop_song(conn):
     assert rowcount[0][0] == 0, "drop_song works"
 
 
-@pytest.mark.skipif(no_db, reason="requires postgresql")
 def test_add_song(conn):
     """test if add_song works as expected"""
     filename = os.listdir("./music/mp3")[0]
@@ -67,7 +125,6 @@ def test_add_song(conn):
     assert rowcount[0][0] != 0, "add_song works"
 
 
-@pytest.mark.skipif(no_db, reason="requires postgresql")
 def test_drop_duplicate(conn):
     """make sure no duplicate exists"""
     d.drop_duplicate(conn)
@@ -80,7 +137,7 @@ def test_drop_duplicate(conn):
     assert count1 == count2, "no duplicate exists in music"
 
 
-@pytest.mark.skipif(no_db, reason="requires postgresql")
+@pytest.mark.skipif(no_ffmpeg, reason="requires ffmpeg to decode mp3")
 def test_add_fingerprint(conn):
     """test if add_fingerprint works"""
     # use the newly-added song in previous test
@@ -98,12 +155,12 @@ def test_add_fingerprint(conn):
     # should have len(t) number of fingerprints added
     # since number of window = len(t)
     cur = conn.cursor()
-    cur.execute('SELECT count(*) FROM fingerprint where song_id = %s', (song_id,))
+    cur.execute('SELECT windows FROM fingerprint where song_id = %s', (song_id,))
     rowcount = cur.fetchall()
     assert rowcount[0][0] == len(t), "add_fingerprint works"
 
 
-@pytest.mark.skipif(no_db, reason="requires postgresql")
+@pytest.mark.skipif(no_ffmpeg, reason="requires ffmpeg to decode mp3")
 def test_update_fingerprinted(conn):
     """test update_fingerprinted status when done"""
     # use the newly-added fingerprints in previous test
@@ -115,16 +172,663 @@ def test_update_fingerprinted(conn):
     assert status[0][0] == 1, "update_fingerprinted works"
 
 
-@pytest.mark.skipif(no_db, reason="requires postgresql")
-def test_snippet(conn):
+def test_snippet(conn, snippet):
     """ test accuracy of matching
 
     pass a snippet of an uploaded song in db,
     should get the correct song back.
     """
-    pathfile = "./music/snippet/Track54.wav"
-    title = f.identify2(conn, pathfile)
-    assert title == "A Tender Feeling", "the answer is correct"
+    titles = f.identify2(conn, snippet)
+    assert titles == ["A Tender Feeling"], "the answer is correct"
+
+
+def test_sqlite_backend(tmp_path):
+    """ fingerprints survive a round-trip through the embedded backend """
+    conn = d.connect("sqlite", str(tmp_path / "freezam.db"))
+    d.create_table(conn)
+    d.add_song(("Tone", "Nobody", "Tests"), conn)
+    d.add_fingerprint("Tone.wav", [0, 1], [0.25, 0.5], [[0.1, 0.2], [0.3, 0.4]], conn,
+                      [7, 8, 7], [0, 1, 2])
+
+    assert d.select_max_song_id(conn) == 1
+    assert d.select_settings(conn) == {}
+    d.add_settings(a.SETTINGS, conn)
+    assert d.select_settings(conn) == a.SETTINGS
+    assert d.select_fingerprint1(conn, 1).tolist() == [0.25, 0.5]
+    assert np.allclose(d.select_fingerprint2(conn, 1), [[0.1, 0.2], [0.3, 0.4]])
+    assert sorted(d.select_hash(conn, [7])) == [(1, 7, 0), (1, 7, 2)]
+    cur = conn.cursor()
+    cur.execute('SELECT fingerprinted FROM music WHERE song_id = 1')
+    assert cur.fetchall() == [(1,)], "fingerprinted in the same transaction"
+    # deleting a song deletes its fingerprints
+    d.drop_song("Tone", conn)
+    assert len(d.select_fingerprint1(conn, 1)) == 0
+    assert d.select_hash(conn, [7, 8]) == []
+    conn.close()
+
+
+def test_add_fingerprints_rollback(tmp_path):
+    """ a failing batch leaves no partial song behind """
+    conn = d.connect("sqlite", str(tmp_path / "freezam.db"))
+    d.create_table(conn)
+    d.add_song(("Tone", None, None), conn)
+    d.add_song(("Noise", None, None), conn)
+    # the hash of the second song does not fit in a BIGINT
+    batch = [("Tone.wav", [0], [0.5], [[0.1]], [1], [0]),
+             ("Noise.wav", [0], [0.5], [[0.1]], [2**70], [0])]
+    with pytest.raises(OverflowError):
+        d.add_fingerprints(batch, conn)
+    assert len(d.select_fingerprint1(conn, 1)) == 0
+    assert d.select_hash(conn, [1]) == []
+    conn.close()
+
+
+def test_migrate(tmp_path):
+    """ one row per window is packed into one row per song """
+    conn = d.connect("sqlite", str(tmp_path / "freezam.db"))
+    d.create_table(conn)
+    assert not d.migrate(conn), "nothing to migrate"
+    d.add_song(("Tone", None, None), conn)
+    cur = conn.cursor()
+    cur.execute('DROP TABLE fingerprint')
+    cur.execute(
+        """CREATE TABLE fingerprint (sig_id SERIAL PRIMARY KEY, song_id INT,
+        center REAL, signature1 NUMERIC, signature2 NUMERIC ARRAY)""")
+    cur.execute(
+        'INSERT INTO fingerprint (song_id, center, signature1, signature2) VALUES '
+        '(%s, %s, %s, %s), (%s, %s, %s, %s)',
+        (1, 1.0, 0.5, [0.3, 0.4], 1, 0.0, 0.25, [0.1, 0.2]))
+    conn.commit()
+
+    assert d.migrate(conn)
+    cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'fingerprint%'")
+    assert cur.fetchall() == [("fingerprint",)], "new table renamed, old one dropped"
+    assert d.select_fingerprint1(conn, 1).tolist() == [0.25, 0.5]
+    assert np.allclose(d.select_fingerprint2(conn, 1), [[0.1, 0.2], [0.3, 0.4]])
+    d.drop_song("Tone", conn)
+    assert len(d.select_fingerprint2(conn, 1)) == 0, "still deleted with its song"
+    conn.close()
+
+
+def test_firststep_parallel(tmp_path, monkeypatch):
+    """ worker processes fingerprint every song, this process records them """
+    os.makedirs(tmp_path / "music" / "mp3")
+    os.makedirs(tmp_path / "music" / "wav")
+    rng = np.random.default_rng(2)
+    titles = ["Song%s" % i for i in range(3)]
+    for title in titles:
+        (tmp_path / "music" / "mp3" / (title + ".mp3")).touch()
+        series = rng.normal(size=(8000*12, 2))
+        wavfile.write(tmp_path / "music" / "wav" / (title + ".wav"), 8000, series)
+    # no mp3 decoding: read the samples from the wav files instead
+    monkeypatch.setattr(c, "meta", lambda pathfile: (os.path.basename(pathfile)[:-4], None, None))
+    monkeypatch.setattr(c, "decode", wav_decode)
+    monkeypatch.chdir(tmp_path)
+
+    conn = d.connect("sqlite", str(tmp_path / "freezam.db"))
+    f.firststep(conn, jobs=2)
+    assert sorted(d.list_all_songs(conn)) == titles
+    cur = conn.cursor()
+    cur.execute('SELECT count(*) FROM music WHERE fingerprinted = 1')
+    assert cur.fetchall() == [(3,)]
+    _, _, t, _ = a.spectrogram(str(tmp_path / "music" / "wav" / "Song0.wav"))
+    for song_id in range(1, 4):
+        assert len(d.select_fingerprint1(conn, song_id)) == len(t)
+    assert d.select_settings(conn) == a.SETTINGS
+    conn.close()
+
+
+def test_sync(tmp_path, monkeypatch):
+    """ only new, changed and unfinished songs are ingested again """
+    os.makedirs(tmp_path / "music" / "mp3")
+    os.makedirs(tmp_path / "music" / "wav")
+    rng = np.random.default_rng(10)
+
+    def write(title):
+        (tmp_path / "music" / "mp3" / (title + ".mp3")).write_bytes(rng.bytes(64))
+        wavfile.write(tmp_path / "music" / "wav" / (title + ".wav"), 8000, rng.normal(size=8000*4))
+
+    for title in ["Song0", "Song1", "Song2"]:
+        write(title)
+    decoded = []
+    monkeypatch.setattr(c, "meta", lambda pathfile: (os.path.basename(pathfile)[:-4], None, None))
+    monkeypatch.setattr(c, "decode", lambda pathfile, rate, keep_wav: decoded.append(pathfile) or wav_decode(
+        pathfile))
+    monkeypatch.chdir(tmp_path)
+    conn = d.connect("sqlite", str(tmp_path / "freezam.db"))
+    f.firststep(conn, jobs=1)
+    stamp = d.select_stamp(conn)
+    assert f.sync(conn, jobs=1) == (0, 0, 3)
+    assert len(decoded) == 3, "nothing read again"
+    assert d.select_stamp(conn) == stamp, "nothing written"
+
+    # touched, changed, deleted, new, and left unfingerprinted by a crash
+    os.utime("./music/mp3/Song0.mp3", (0, 0))
+    write("Song1")
+    os.remove("./music/mp3/Song2.mp3")
+    write("Song3")
+    write("Song4")
+    d.add_song(("Song4", None, None), conn, c.stat("./music/mp3/Song4.mp3"))
+    assert f.sync(conn, jobs=1) == (3, 1, 1)
+    assert sorted(decoded[3:]) == ["./music/mp3/Song%s.mp3" % i for i in (1, 3, 4)]
+    assert sorted(d.list_all_songs(conn)) == ["Song0", "Song1", "Song3", "Song4"]
+    cur = conn.cursor()
+    cur.execute('SELECT count(*) FROM music WHERE fingerprinted = 1')
+    assert cur.fetchall() == [(4,)]
+
+    # added with a path written differently
+    write("Song5")
+    f.add_single(conn, "music/mp3/Song5.mp3")
+    assert f.sync(conn, jobs=1) == (0, 0, 5)
+
+    # a database built before settings were recorded keeps its settings
+    cur.execute("DROP TABLE settings")
+    conn.commit()
+    assert f.sync(conn, jobs=1) == (0, 0, 5)
+    assert f.load_settings(conn) == a.LEGACY_SETTINGS
+    conn.close()
+
+    # a database built before fingerprints were packed one row per song
+    for title in ["Song1", "Song3", "Song4", "Song5"]:
+        os.remove("./music/mp3/%s.mp3" % title)
+    (tmp_path / "music" / "mp3" / "Song6.mp3").write_bytes(rng.bytes(64))
+    wavfile.write(tmp_path / "music" / "wav" / "Song6.wav", 8000, rng.normal(size=8000*12))
+    conn = d.connect("sqlite", str(tmp_path / "old.db"))
+    cur = conn.cursor()
+    cur.execute(
+        """CREATE TABLE music (song_id SERIAL PRIMARY KEY, title TEXT not null, artist TEXT,
+        album TEXT, address TEXT, url TEXT, fingerprinted INT default 0)""")
+    cur.execute(
+        """CREATE TABLE fingerprint (sig_id SERIAL PRIMARY KEY, song_id INT,
+        center REAL, signature1 NUMERIC, signature2 NUMERIC ARRAY)""")
+    cur.execute("INSERT INTO music (title, fingerprinted) VALUES ('Song0', 1)")
+    cur.execute('INSERT INTO fingerprint (song_id, center, signature1, signature2) VALUES (%s, %s, %s, %s)',
+                (1, 5.0, 0.5, [0.1] * 8))
+    conn.commit()
+    assert f.sync(conn, jobs=1) == (1, 0, 1)
+    assert d.select_fingerprint1(conn, 1).tolist() == [0.5], "migrated"
+    assert len(d.select_fingerprint1(conn, 2)) > 0, "ingested"
+    catalog.invalidate()
+    index.invalidate()
+    conn.close()
+
+
+def test_cache(tmp_path, monkeypatch):
+    """ a song is decoded once, and fingerprinted once per settings """
+    pathfile = str(tmp_path / "Song.mp3")
+    (tmp_path / "Song.mp3").write_bytes(b"not really an mp3")
+    series = np.random.default_rng(11).normal(size=(8000*6, 2))
+    decoded = []
+    monkeypatch.setattr(c, "meta", lambda pathfile: ("Song", None, None))
+    monkeypatch.setattr(c, "decode", lambda pathfile, rate, keep_wav: decoded.append(pathfile) or (8000, iter([series])))
+    monkeypatch.setattr(cache, "CACHE", str(tmp_path / "cache"))
+    os.makedirs(cache.CACHE)
+
+    first = f.ingest_file(pathfile)[1]
+    again = f.ingest_file(pathfile)[1]
+    assert len(decoded) == 1
+    assert isinstance(again[2], np.memmap), "mapped from the cache"
+    for x, y in zip(first[1:], again[1:]):
+        assert np.array_equal(x, y)
+    settings = {"fingerprint": dict(a.SETTINGS["fingerprint"], window=0.5), "hash": a.SETTINGS["hash"]}
+    assert len(f.ingest_file(pathfile, settings=settings)[1][1]) != len(first[1])
+    assert len(decoded) == 1, "samples reused for new settings"
+
+    # least recently used entries go first
+    name = cache.key("features", c.stat(pathfile)[3], a.SETTINGS)
+    cache.get(name, f.FEATURES)
+    cache.evict(cache.CACHE, sum(file.stat().st_size for file in os.scandir(tmp_path / "cache" / name)))
+    assert os.listdir(cache.CACHE) == [name]
+
+
+def test_spectrogram_series(tmp_path):
+    """ samples in memory give the same spectrogram as the wav file """
+    series = np.random.default_rng(3).normal(size=(8000*12, 2))
+    wavfile.write(tmp_path / "noise.wav", 8000, series)
+    _, f1, t1, spect1 = a.spectrogram(str(tmp_path / "noise.wav"))
+    _, f2, t2, spect2 = a.spectrogram_series(8000, series)
+    assert np.allclose(spect1, spect2)
+    # one channel works too
+    _, _, _, spect3 = a.spectrogram_series(8000, series.mean(axis=1))
+    assert np.allclose(spect1, spect3)
+
+
+def test_stream_fingerprints(tmp_path):
+    """ streaming block by block gives the same fingerprints """
+    series = np.random.default_rng(4).normal(size=(4000*40, 2))
+    wavfile.write(tmp_path / "noise.wav", 4000, series)
+    framerate, f, t, spect = a.spectrogram(str(tmp_path / "noise.wav"))
+    blocks = list(a.stream_fingerprints(*a.read(str(tmp_path / "noise.wav")), block=4))
+    assert len(blocks) > 1
+    assert np.allclose(np.concatenate([b[0] for b in blocks]), t)
+    assert np.allclose(np.concatenate([b[1] for b in blocks]), a.fingerprint(f, spect))
+    assert np.allclose(np.concatenate([b[2] for b in blocks]), a.fingerprint2(f, spect, framerate))
+
+    _, _, _, spect = a.spectrogram(str(tmp_path / "noise.wav"), a.SETTINGS["hash"])
+    hashes, anchors = a.fingerprint3(spect)
+    blocks = list(a.stream_hashes(*a.read(str(tmp_path / "noise.wav")), block=16))
+    assert len(blocks) > 1
+    streamed = zip(np.concatenate([b[0] for b in blocks]), np.concatenate([b[1] for b in blocks]))
+    assert sorted(streamed) == sorted(zip(hashes, anchors))
+
+
+def test_decode(tmp_path, monkeypatch):
+    """ decoded samples are read from ffmpeg as they come, no wav written """
+    import sys
+    import subprocess
+    from pydub import AudioSegment
+    # a stand-in for ffmpeg reading a wav named .mp3: the first channel
+    # to stdout, and the wav copied to the output after "-f wav"
+    converter = tmp_path / "ffmpeg"
+    converter.write_text(
+        "#!%s\nimport sys, shutil\nfrom scipy.io import wavfile\n"
+        "args = sys.argv\n"
+        "framerate, series = wavfile.read(args[args.index('-i') + 1])\n"
+        "if 'wav' in args:\n"
+        "    shutil.copy(args[args.index('-i') + 1], args[args.index('wav') + 1])\n"
+        "sys.stdout.buffer.write(series[:, 0].tobytes())\n" % sys.executable)
+    converter.chmod(0o755)
+    monkeypatch.setattr(AudioSegment, "converter", str(converter))
+    monkeypatch.setattr(c, "BLOCK", 1)
+    series = (np.random.default_rng(6).normal(size=(8000*5, 2)) * 3000).astype(np.int16)
+    wavfile.write(tmp_path / "Song.mp3", 8000, series)
+    temporary = set(os.listdir(tempfile.gettempdir()))
+
+    framerate, blocks = c.decode(str(tmp_path / "Song.mp3"), 8000)
+    blocks = list(blocks)
+    assert framerate == 8000 and len(blocks) == 5, "a second at a time"
+    assert np.array_equal(np.concatenate(blocks), series[:, :1])
+    assert set(os.listdir(tempfile.gettempdir())) <= temporary, "no wav written"
+    streamed = f.stream_fingerprints(*c.decode(str(tmp_path / "Song.mp3"), 8000))
+    for x, y in zip(streamed, f.compute_fingerprints(8000, series[:, 0])):
+        assert np.allclose(np.sort(x, axis=0), np.sort(y, axis=0))
+    with pytest.raises(subprocess.CalledProcessError):
+        list(c.decode(str(tmp_path / "Missing.mp3"), 8000)[1])
+
+    monkeypatch.chdir(tmp_path)
+    list(c.decode("Song.mp3", 8000, keep_wav=True)[1])
+    assert np.array_equal(wavfile.read("./music/wav/Song.wav")[1], series)
+
+
+def test_resample():
+    """ resampling slices of a recording agrees with resampling it all """
+    series = np.random.default_rng(5).normal(size=(44100*3, 2))
+    full = a.resample(series, 44100, 8000)
+    assert len(full) == 8000*3
+    assert np.allclose(a.resample(series, 44100, 8000, 1234, 5678), full[1234:5678])
+    assert np.allclose(a.resample(series, 44100, 44100), series.mean(axis=1))
+
+
+def test_fingerprint2_bands():
+    """ each band gives the same as fingerprint() on its slice """
+    series = np.random.default_rng(6).normal(size=8000*5)
+    rate, f, t, spect = a.spectrogram_series(8000, series)
+    for layout, n_bands in [("octave", 8), ("third", 24), ("mel", 8)]:
+        edges = a.band_edges(len(f), float(f[1] - f[0]), rate, layout)
+        fingerprints = a.fingerprint2(f, spect, rate, layout)
+        assert fingerprints.shape == (len(t), n_bands)
+        for k in range(n_bands):
+            start, end = edges[k], edges[k+1]
+            assert np.allclose(fingerprints[:, k], a.fingerprint(f[start:end], spect[start:end]))
+
+
+def test_catalog(tmp_path, monkeypatch):
+    """ the catalog is loaded once, reloaded on change, and snapshotted """
+    conn = d.connect("sqlite", str(tmp_path / "freezam.db"))
+    d.create_table(conn)
+    for title, n in [("One", 2), ("Two", 3)]:
+        d.add_song((title, None, None), conn)
+        d.add_fingerprint(title + ".wav", list(range(n)), [0.5] * n, [[0.1, 0.2]] * n, conn)
+    cat = catalog.load(conn, 2)
+    assert list(cat.songs) == [1, 2]
+    assert list(cat.offsets) == [0, 2, 5]
+    assert list(cat.song_ids) == [1, 1, 2, 2, 2]
+    assert cat.records.dtype == np.float32 and cat.records.shape == (5, 2)
+    assert catalog.load(conn, 2) is cat, "loaded once"
+
+    d.drop_song("One", conn)
+    cat = catalog.load(conn, 2)
+    assert list(cat.songs) == [2], "reloaded after a change"
+
+    catalog.invalidate()
+    catalog.load(conn, 1, snapshot=str(tmp_path / "snapshot"))
+    catalog.invalidate()
+    cat = catalog.load(conn, 1, snapshot=str(tmp_path / "snapshot"))
+    assert isinstance(cat.records, np.memmap), "mapped from the snapshot"
+    assert list(cat.records) == [0.5] * 3
+
+    # rebuilt by another process, same songs and song_ids
+    stamp = d.select_stamp(conn)
+    monkeypatch.setattr(d, "changed", lambda: None)
+    d.create_table(conn)
+    for title in ["One", "Two"]:
+        d.add_song((title, None, None), conn)
+        d.add_fingerprint(title + ".wav", [0, 1, 2], [0.75] * 3, [[0.1, 0.2]] * 3, conn)
+    d.drop_song("One", conn)
+    assert d.select_stamp(conn)[3:] == stamp[3:] and d.select_stamp(conn) != stamp
+    assert list(catalog.load(conn, 1, snapshot=None).records) == [0.75] * 3, "reloaded"
+    catalog.invalidate()
+    cat = catalog.load(conn, 1, snapshot=str(tmp_path / "snapshot"))
+    assert list(cat.records) == [0.75] * 3, "not the old snapshot"
+    catalog.invalidate()
+    conn.close()
+
+
+def test_catalog_query(tmp_path):
+    """ one query for the catalog """
+    conn = d.connect("sqlite", str(tmp_path / "freezam.db"))
+    d.create_table(conn)
+    for title, values in [("One", [0.1, 0.12]), ("Two", [0.7, 0.8])]:
+        d.add_song((title, None, None), conn)
+        d.add_fingerprint(title + ".wav", [0.5, 1], values, [[v, v] for v in values], conn)
+    # not fingerprinted
+    d.add_song(("Three", None, None), conn)
+    metrics.reset()
+    cat = catalog.read_database(conn, 1, None)
+    assert list(cat.songs) == [1, 2] and list(cat.offsets) == [0, 2, 4]
+    assert metrics.snapshot()["counters"]["db_queries"] == 1
+    assert [song for song, _, _ in d.select_fingerprints(conn, 2, size=1)] == [1, 2], "one song per fetch"
+    catalog.invalidate()
+    conn.close()
+
+
+def test_server(tmp_path, library):
+    """ the server identifies paths and uploads, several clients at once """
+    import json
+    import functools
+    import urllib.request
+    from concurrent.futures import ThreadPoolExecutor
+    import server
+
+    path = str(tmp_path / "freezam.db")
+    _, songs = library(["One", "Two"], 12, seed=5)
+    for title, series in songs.items():
+        wavfile.write(tmp_path / (title + ".wav"), 8000, series)
+
+    app = server.make_server(("127.0.0.1", 0), functools.partial(d.connect, "sqlite", path))
+    server.warm(app)
+    metrics.reset()
+    server.start(app)
+    url = "http://127.0.0.1:%s" % app.server_address[1]
+
+    def get(query):
+        with urllib.request.urlopen(url + query) as response:
+            return json.load(response)
+
+    with ThreadPoolExecutor(4) as pool:
+        answers = list(pool.map(get, ["/identify?type=%s&path=%s" % (type, tmp_path / "Two.wav")
+                                      for type in (2, 3, 2, 3)]))
+    assert [answer["matches"][0]["title"] for answer in answers] == ["Two"] * 4
+    assert all(answer["seconds"] > 0 for answer in answers)
+
+    with open(tmp_path / "One.wav", "rb") as file:
+        request = urllib.request.Request(url + "/identify?type=3", data=file.read())
+    with urllib.request.urlopen(request) as response:
+        assert json.load(response)["matches"][0]["title"] == "One"
+    assert sorted(get("/songs")["titles"]) == ["One", "Two"]
+    with urllib.request.urlopen(url + "/metrics") as response:
+        assert b'freezam_calls_total{stage="fun.identify"} 5' in response.read()
+    with pytest.raises(urllib.error.HTTPError):
+        get("/identify?type=4&path=%s" % (tmp_path / "One.wav"))
+
+    app.shutdown()
+    app.server_close()
+    app.pool.close()
+
+
+def test_identify_batch(tmp_path, library):
+    """ snippets of a directory are identified against one catalog """
+    import io
+    import json
+    conn, songs = library(["One", "Two", "Three"], 20, seed=6)
+    pathfiles = []
+    for title, series in songs.items():
+        pathfiles.append(str(tmp_path / (title + ".wav")))
+        # a snippet starting 6 s into the song
+        wavfile.write(pathfiles[-1], 8000, series[8000*6:8000*14])
+    pathfiles.append(str(tmp_path / "missing.wav"))
+
+    results = list(f.identify_batch(conn, pathfiles, type=3, top=2, jobs=2))
+    assert [r["matches"][0]["title"] for r in results[:3]] == ["One", "Two", "Three"]
+    assert abs(results[0]["matches"][0]["offset"] - 6) < 0.2
+    assert set(results[0]["seconds"]) == {"analyze", "match", "lookup"}
+    assert "error" in results[3]
+    results = list(f.identify_batch(conn, pathfiles[:3], type=2, top=2, jobs=1))
+    assert [r["matches"][0]["title"] for r in results] == ["One", "Two", "Three"]
+
+    file = io.StringIO()
+    f.write_results(results, file)
+    assert [json.loads(line)["path"] for line in file.getvalue().splitlines()] == pathfiles[:3]
+    file = io.StringIO()
+    f.write_results(results, file, "csv")
+    assert len(file.getvalue().splitlines()) == 1 + sum(len(r["matches"]) for r in results)
+
+
+def test_align(tmp_path, library):
+    """ all windows of a snippet vote for its offset in the right song """
+    conn, songs = library(["One", "Two"], 60, seed=8)
+    rng = np.random.default_rng(18)
+    # 20 s of the second song, from 30 s, with a little noise
+    snippet = songs["Two"][8000*30:8000*50] + rng.normal(scale=0.01, size=8000*20)
+    wavfile.write(tmp_path / "snippet.wav", 8000, snippet)
+    for type in (1, 2):
+        matches, confidence = f.identify(conn, str(tmp_path / "snippet.wav"), type)
+        assert [match["title"] for match in matches] == ["Two"]
+        assert matches[0]["offset"] == 30
+        assert matches[0]["score"] > 0.5 and confidence > 0.5
+
+    # the comparison stops once a song clearly wins
+    cat = catalog.load(conn, 2)
+    framerate, freqs, t, spect = a.spectrogram(str(tmp_path / "snippet.wav"))
+    fingerprints = a.fingerprint2(freqs, spect, framerate)
+    (song_ids, scores, offsets), n = a.align(
+        cat.records, cat.song_ids, cat.centers, fingerprints, t, 0.5, step=8, lead=10)
+    assert n < len(t) and song_ids[np.argmax(scores)] == 2
+    assert list(a.candidates(cat.song_ids, fingerprints, cat.records, 1)) == [2], "pre-filter"
+    assert d.select_titles([2, 1, 2], conn) == {1: "One", 2: "Two"}
+
+    # as much noise as signal: few hashes survive, still reported
+    wavfile.write(tmp_path / "noisy.wav", 8000, songs["Two"][8000*30:8000*40] + rng.normal(size=8000*10))
+    matches, _ = f.identify(conn, str(tmp_path / "noisy.wav"), 3)
+    assert [match["title"] for match in matches[:1]] == ["Two"] and matches[0]["score"] < f.MIN_SCORE[1]
+
+    wavfile.write(tmp_path / "noise.wav", 8000, rng.normal(size=8000*20))
+    for type in (1, 2, 3):
+        matches, confidence = f.identify(conn, str(tmp_path / "noise.wav"), type)
+        assert matches == [] and confidence < 0.1, "no match above the threshold"
+        assert f.identify(conn, str(tmp_path / "noise.wav"), type, threshold=0)[0], "ranked anyway"
+
+
+def test_index(tmp_path, monkeypatch, library):
+    """ the k-d tree finds the same matches as comparing every window """
+    conn, _ = library(["One", "Two", "Three"], 30, seed=9)
+    rng = np.random.default_rng(19)
+    tree = index.build(conn)
+    assert os.path.isfile(str(tmp_path / "freezam.db.kdtree")), "saved next to the database"
+    index.invalidate()
+    assert index.load(conn).n == tree.n == 3 * 59, "read back"
+
+    cat = catalog.load(conn, 2)
+    snippet = cat.records[70:90] + rng.uniform(-0.05, 0.05, size=(20, cat.records.shape[1]))
+    rows, cols = index.query(tree, snippet)
+    pairs = set(zip(rows.tolist(), cols.tolist()))
+    exact = set(zip(*np.nonzero(a.match2_all_pairs(cat.records, snippet))))
+    assert exact <= pairs, "no match missed with eps=0"
+    t = np.arange(20) * 0.5
+    assert np.array_equal(
+        a.align(cat.records, cat.song_ids, cat.centers, snippet, t, 0.5)[0][1],
+        a.align(cat.records, cat.song_ids, cat.centers, snippet, t, 0.5,
+                search=lambda chunk: index.query(tree, chunk))[0][1])
+
+    d.drop_song("One", conn)
+    assert index.load(conn).n == 2 * 59, "rebuilt after a change"
+
+    # rebuilt by another process with the same songs, other fingerprints
+    monkeypatch.setattr(d, "changed", lambda: None)
+    d.create_table(conn)
+    for title in ["One", "Two", "Three"]:
+        d.add_song((title, None, None), conn)
+        d.add_fingerprint(title + ".wav", np.arange(59) * 0.5, np.zeros(59), np.full((59, 8), 0.75), conn)
+    d.drop_song("One", conn)
+    assert np.all(index.load(conn).data == 0.75), "not the saved tree"
+
+
+def test_candidates(tmp_path, monkeypatch, library):
+    """ only the songs picked by the pre-filter are aligned """
+    conn, songs = library(["One", "Two", "Three"], 30, seed=10)
+    monkeypatch.setattr(a, "CANDIDATES", 1)
+    wavfile.write(tmp_path / "snippet.wav", 8000, songs["Three"][8000*10:8000*20])
+    for type in (1, 2):
+        matches, confidence = f.identify(conn, str(tmp_path / "snippet.wav"), type, k=3)
+        assert [match["title"] for match in matches] == ["Three"] and matches[0]["offset"] == 10
+
+
+def test_listen(tmp_path, library):
+    """ a stream is identified from its first seconds """
+    import io
+    import listen
+    conn, songs = library(["One", "Two"], 40, seed=12, channels=2, scale=3000)
+    series = songs["Two"]
+    # a wav stream from 20 s into the second song
+    wavfile.write(tmp_path / "stream.wav", 8000, series[8000*20:].astype(np.int16))
+    for type in (1, 2, 3):
+        with open(tmp_path / "stream.wav", "rb") as stream:
+            heard, match, confidence = listen.identify_stream(conn, stream, type)
+        assert match["title"] == "Two" and match["offset"] == 20
+        assert heard < 5 and confidence >= listen.THRESHOLD
+
+    # the rolling spectrogram is the spectrogram of the whole stream
+    samples = series[:8000*20].astype(np.int16)
+    rolling = a.Rolling(44100, a.SETTINGS["fingerprint"], seconds=6)
+    stream = io.BytesIO(np.repeat(samples, 5, axis=0)[:, :1].tobytes())
+    for block in listen.read(stream, 1, 1000):
+        rolling.add(block)
+    _, _, t, spect = a.spectrogram_series(44100, np.repeat(samples, 5, axis=0)[:, :1])
+    window = slice(rolling.first, rolling.first + len(rolling.t))
+    assert len(rolling.t) == 12 and np.allclose(rolling.t, t[window])
+    assert np.allclose(rolling.spect, spect[:, window])
+
+
+def test_bench(tmp_path):
+    """ the benchmark times every stage of a tiny synthetic catalog """
+    results = bench.run(songs=3, seconds=12, snippets=2, types=(1, 3), directory=str(tmp_path))
+    for stage in ["spectrogram", "fingerprint2", "db_write", "identify1", "identify3"]:
+        report = results["stages"][stage]
+        assert report["count"] > 0 and report["p50"] <= report["p99"] <= report["max"]
+    assert results["stages"]["identify1"]["count"] == 2
+    assert results["accuracy"]["identify1"] == 1
+    assert results["peak_rss_bytes"] > 0
+
+
+def test_metrics(tmp_path, library):
+    """ stages are timed and sizes counted, also in worker processes """
+    metrics.reset()
+    conn, songs = library(["One"], 12, seed=3)
+    wavfile.write(tmp_path / "snippet.wav", 8000, songs["One"][8000*2:8000*7])
+    matches, _ = f.identify(conn, str(tmp_path / "snippet.wav"), 2)
+    assert matches[0]["title"] == "One"
+    snapshot = metrics.snapshot()
+    assert snapshot["timers"]["fun.identify"]["calls"] == 1
+    assert snapshot["timers"]["fun.identify"]["wall"] >= snapshot["timers"]["fun.rank"]["wall"]
+    assert snapshot["counters"]["db_queries"] > 0 and snapshot["counters"]["db_rows_read"] > 0
+    # one 1 s window every 0.5 s: 23 windows in the song, 9 in the snippet
+    assert snapshot["counters"]["windows"] >= 23 + 9
+    assert snapshot["peak_memory"] > 0
+    assert 'freezam_calls_total{stage="fun.identify"} 1' in metrics.prometheus()
+
+    # results of two workers, and their metrics
+    metrics.reset()
+    results = f.analyze_snippets([str(tmp_path / "snippet.wav")] * 2, 3, a.SETTINGS, jobs=2)
+    assert len(list(results)) == 2
+    assert metrics.snapshot()["timers"]["fun.snippet_fingerprints"]["calls"] == 2
+    metrics.dump(str(tmp_path / "metrics.prom"))
+    assert "freezam_hashes_total" in (tmp_path / "metrics.prom").read_text()
+
+
+def test_startup(tmp_path):
+    """ light commands do not load numpy, scipy or matplotlib """
+    import sys
+    import subprocess
+    conn = d.connect("sqlite", str(tmp_path / "freezam.db"))
+    d.create_table(conn)
+    d.add_song(("One", None, None), conn)
+    conn.close()
+    env = dict(os.environ, FREEZAM_DB=str(tmp_path / "freezam.db"),
+               PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    script = ("import sys; sys.argv = ['interface.py', 'list']; import interface; "
+              "print(sorted({'numpy', 'scipy', 'matplotlib', 'pydub'} & set(sys.modules)))")
+    out = subprocess.run([sys.executable, "-c", script], cwd=tmp_path, env=env,
+                         capture_output=True, text=True, check=True).stdout
+    assert out.split("\n")[:2] == ["One", "[]"]
+
+    # plot the spectrogram to a file
+    wavfile.write(tmp_path / "song.wav", 8000, np.random.default_rng(0).normal(size=8000*3))
+    subprocess.run([sys.executable, "-c", "import interface", "plot", "--pathfile", "song.wav",
+                    "--output", "plot.png"], cwd=tmp_path, env=dict(env, MPLBACKEND="Agg"), check=True)
+    assert (tmp_path / "plot.png").stat().st_size > 0
+
+
+def test_session(tmp_path):
+    """ bounded pool, nested transactions, prepared statements """
+    import functools
+    from concurrent.futures import ThreadPoolExecutor
+    path = str(tmp_path / "freezam.db")
+    conn = d.connect("sqlite", path)
+    d.create_table(conn)
+
+    # a failing block rolls back the writes of the blocks inside it
+    with pytest.raises(IndexError):
+        with d.transaction(conn):
+            d.add_song(("One", None, None), conn)
+            d.add_fingerprints([("Two.wav", [0.5], [0.1], [[0.1] * 8], [], [])], conn)
+    assert d.list_all_songs(conn) == []
+    with d.transaction(conn):
+        d.add_song(("One", None, None), conn)
+        d.add_fingerprints([("One.wav", [0.5], [0.1], [[0.1] * 8], [], [])], conn)
+    assert d.select_fingerprint2(conn, 1).shape == (1, 8)
+
+    # at most size connections, each used by one thread at a time
+    pool = d.Pool(functools.partial(d.connect, "sqlite", path), size=2, timeout=0.1)
+    with pool.connection() as first, pool.connection() as second:
+        assert first is not second
+        with pytest.raises(TimeoutError):
+            pool.get()
+
+    def titles(_):
+        with pool.connection() as conn:
+            return d.list_all_songs(conn)
+    with ThreadPoolExecutor(8) as threads:
+        assert list(threads.map(titles, range(16))) == [["One"]] * 16
+    assert pool.idle.qsize() == 2
+    pool.close()
+    conn.close()
+
+    assert d.to_prepared("select_hash", 'SELECT song_id FROM hash WHERE hash = ANY(%s) AND anchor > %s') == (
+        "PREPARE select_hash AS SELECT song_id FROM hash WHERE hash = ANY($1) AND anchor > $2",
+        "EXECUTE select_hash (%s, %s)")
+
+
+def test_fingerprint3(tmp_path):
+    """ a snippet cut from a song votes for the right offset """
+    rate = 8000
+    rng = np.random.default_rng(0)
+    series = rng.normal(size=rate*40)
+    song = tmp_path / "song.wav"
+    wavfile.write(song, rate, np.stack([series, series], axis=1))
+    snippet = tmp_path / "snippet.wav"
+    part = series[rate*12:rate*32]
+    wavfile.write(snippet, rate, np.stack([part, part], axis=1))
+
+    settings = a.SETTINGS["hash"]
+    _, _, _, spect = a.spectrogram(str(song), settings)
+    hashes, anchors = a.fingerprint3(spect)
+    records = np.stack([np.ones_like(hashes), hashes, anchors], axis=1)
+    _, _, _, spect = a.spectrogram(str(snippet), settings)
+    s_hashes, s_anchors = a.fingerprint3(spect)
+    song_ids, scores, offsets = a.vote(s_hashes, s_anchors, records)
+
+    assert list(song_ids) == [1]
+    assert offsets[0] * settings["hop"] == 12, "snippet starts 12s into the song"
 
 
 # NOTE:
@@ -138,7 +842,6 @@ def test_snippet(conn):
 
 # TODO:
 
-@pytest.mark.skipif(no_db, reason="requires postgresql")
 def test_dummy(conn):
     """ dummy!
 
@@ -148,7 +851,6 @@ def test_dummy(conn):
     assert 1 == 1
 
 
-@pytest.mark.skipif(no_db, reason="requires postgresql")
 def test_noise(conn):
     """ test match with noise
 